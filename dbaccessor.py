@@ -1,8 +1,28 @@
 #dbaccessor.py
 
+import array
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import gzip
+import itertools
 import json
+import operator
 import os
+import re
 import sqlite3
+import threading
+import time
+import urllib.parse
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 
 
@@ -25,31 +45,67 @@ class DbSchemaValidator(object):
   can go out-of-date if someone changes the database's schema 
   by creating or dropping tables, for example.
   '''
+  # every rowid table also answers to these column names
+  ROWID_NAMES = frozenset(['rowid', 'oid', '_rowid_'])
+
   def __init__(self, dbschema):
     self.dbschema = dbschema 
 
+    # sqlite identifiers are case-insensitive, so the lookups are
+    # keyed on lowercased table and field names
     table_field_dict = {}
 
     for table_name in dbschema.keys():
-      field_name_list = [fname_ftype_list[0] for fname_ftype_list in dbschema[table_name]]
-      table_field_dict[table_name] = field_name_list
+      field_name_set = frozenset(fname_ftype_list[0].lower() for fname_ftype_list in dbschema[table_name])
+      table_field_dict[table_name.lower()] = field_name_set
 
     self.table_field_dict = table_field_dict
 
 
 
   def is_table(self, table_name): 
-    return table_name in self.dbschema 
+    return table_name.lower() in self.table_field_dict 
 
 
   def is_field(self, table_name, field_name): 
     if not self.is_table(table_name):
       raise DbSchemaValidatorError("table %s is not in dbschema." % table_name)  
 
-    #field_name_list = [fnt[0] for fnt in self.dbschema[table_name]]
-    field_name_list = self.table_field_dict[table_name]
+    return field_name.lower() in self.table_field_dict[table_name.lower()]
+
+  def validate_query(self, table_name, columns=None, where_row_list=None, sort_cols=None):
+    '''
+    Checks every table and column name a read, update or delete would
+    use: columns, the columns in where_row_list (including OR groups)
+    and the columns in sort_cols. Raises DbSchemaValidatorError naming
+    the first unknown name; returns True otherwise.
+    '''
+    if not self.is_table(table_name):
+      raise DbSchemaValidatorError("table %s is not in dbschema." % table_name)
+
+    field_name_set = self.table_field_dict[table_name.lower()]
+    col_names = list(columns or [])
+    col_names.extend(DbSchemaValidator.get_where_col_names(where_row_list))
+    col_names.extend(col_name for col_name, _ in sort_cols or [])
+
+    for col_name in col_names:
+      name = col_name.lower()
+      if name not in field_name_set and name not in DbSchemaValidator.ROWID_NAMES:
+        raise DbSchemaValidatorError("field %s is not in table %s." % (col_name, table_name))
 
-    return field_name in field_name_list 
+    return True
+
+  @staticmethod
+  def get_where_col_names(where_row_list):
+    col_names = []
+    for col in where_row_list or []:
+      if DbAccessor.is_or_group(col):
+        for sub_where_row_list in col[1]:
+          col_names.extend(DbSchemaValidator.get_where_col_names(sub_where_row_list))
+      else:
+        col_names.append(col[0])
+
+    return col_names
 
   def get_dbschema_json_str(self):
     return json.dumps(self.dbschema, indent=4,sort_keys=True)
@@ -62,30 +118,507 @@ class DbSchemaValidator(object):
 
 
 
+class ConnectionPool(object):
+  '''
+  A bounded pool of sqlite3 connections shared by threads.
+  connect is a callable that opens a new connection; at most size
+  connections are open at once. A thread that checks a connection
+  back in is handed the same connection on its next checkout if it
+  is still idle (per-thread affinity), which keeps that connection's
+  page cache and prepared statements warm. Connections idle for more
+  than max_idle seconds are closed, and checkout waits at most timeout
+  seconds (forever if None) for a connection to be checked in.
+  '''
+  def __init__(self, connect, size=4, max_idle=None, timeout=None):
+    if size < 1:
+      raise DbAccessorError('bad pool size: %s' % size)
+
+    self.connect = connect
+    self.size = size
+    self.max_idle = max_idle
+    self.timeout = timeout
+
+    self.cond = threading.Condition()
+    self.local = threading.local()
+    self.idle = []      # [(conn, time checked in), ...]
+    self.open_count = 0
+    self.closed = False
+
+    self.stats = {'checkouts': 0, 'waits': 0, 'timeouts': 0, 'opened': 0,
+      'evicted': 0, 'affinity_hits': 0, 'peak_in_use': 0}
+
+
+  def checkout(self):
+    deadline = None if self.timeout is None else time.time() + self.timeout
+
+    with self.cond:
+      while True:
+        if self.closed:
+          raise DbAccessorError('connection pool is closed')
+
+        self.evict_idle()
+        conn = self.take_idle()
+        if conn is not None: break
+
+        if self.open_count < self.size:
+          self.open_count += 1
+          try:
+            conn = self.connect()
+          except Exception:
+            self.open_count -= 1
+            raise
+          self.stats['opened'] += 1
+          break
+
+        self.stats['waits'] += 1
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+          self.stats['timeouts'] += 1
+          raise DbAccessorError('timed out waiting for a pooled connection')
+        self.cond.wait(remaining)
+
+      self.stats['checkouts'] += 1
+      in_use = self.open_count - len(self.idle)
+      if in_use > self.stats['peak_in_use']: self.stats['peak_in_use'] = in_use
+
+    self.local.last_conn = conn
+    return conn
+
+
+  def checkin(self, conn):
+    with self.cond:
+      if self.closed:
+        self.open_count -= 1
+        conn.close()
+        return
+
+      self.idle.append((conn, time.time()))
+      self.evict_idle()
+      self.cond.notify()
+
+
+  def take_idle(self):
+    # prefer the connection this thread used last
+    last_conn = getattr(self.local, 'last_conn', None)
+    for i, (conn, _) in enumerate(self.idle):
+      if conn is last_conn:
+        del self.idle[i]
+        self.stats['affinity_hits'] += 1
+        return conn
+
+    if self.idle: return self.idle.pop()[0]
+    return None
+
+
+  def evict_idle(self):
+    if self.max_idle is None: return
+
+    cutoff = time.time() - self.max_idle
+    keep = []
+    for conn, checkin_time in self.idle:
+      if checkin_time < cutoff:
+        conn.close()
+        self.open_count -= 1
+        self.stats['evicted'] += 1
+      else:
+        keep.append((conn, checkin_time))
+    self.idle = keep
+
+
+  def get_stats(self):
+    with self.cond:
+      stats = dict(self.stats)
+      stats['size'] = self.size
+      stats['open'] = self.open_count
+      stats['idle'] = len(self.idle)
+      stats['in_use'] = self.open_count - len(self.idle)
+    return stats
+
+
+  def close(self):
+    with self.cond:
+      self.closed = True
+      for conn, _ in self.idle:
+        conn.close()
+        self.open_count -= 1
+      self.idle = []
+      self.cond.notify_all()
+
+
+
+
+
+
+class StatementCache(object):
+  '''
+  A thread-safe LRU mapping of query shape -> SQL text, holding at
+  most maxsize entries. DbAccessor uses it so that a query shape it
+  has built before is not built again; the bound values still come
+  from each call.
+  '''
+  def __init__(self, maxsize=256):
+    self.maxsize = maxsize
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    with self.lock:
+      stmt = self.entries.get(key)
+      if stmt is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self.entries.move_to_end(key)
+      return stmt
+
+  def put(self, key, stmt):
+    with self.lock:
+      self.entries[key] = stmt
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def items(self):
+    with self.lock:
+      return list(self.entries.items())
+
+  def get_stats(self):
+    with self.lock:
+      return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+        'size': len(self.entries), 'maxsize': self.maxsize}
+
+
+
+
+
+
+class StatementMetrics(object):
+  '''
+  Collects per-statement metrics from DbAccessor.try_execute: a latency
+  histogram, call count and row count (rows changed by a write, rows
+  fetched from a read) for each normalized SQL text
+  (whitespace collapsed, IN (?, ?, ...) lists shortened to IN (?...)),
+  error counts by exception class, and a log of statements slower than
+  slow_query_threshold seconds with the shape (types) of their bound
+  parameters -- never the values. log (optional) is called with each
+  slow query entry.
+
+  Latency is the time spent in execute/executemany; for a SELECT that
+  is the time to the first row, not the time to fetch them all.
+  '''
+  BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+  IN_LIST_RE = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+
+  def __init__(self, slow_query_threshold=None, log=None, max_slow_queries=100):
+    self.slow_query_threshold = slow_query_threshold
+    self.log = log
+    self.lock = threading.Lock()
+    self.normalized = {}
+    self.slow_queries = collections.deque(maxlen=max_slow_queries)
+    self.clear()
+
+  def clear(self):
+    with self.lock:
+      self.statements = {}
+      self.errors = {}
+      self.slow_queries.clear()
+
+  def normalize_sql(self, stmt):
+    sql = self.normalized.get(stmt)
+    if sql is None:
+      sql = StatementMetrics.IN_LIST_RE.sub('IN (?...)', ' '.join(stmt.split())).rstrip(';')
+      if len(self.normalized) < 10000: self.normalized[stmt] = sql
+    return sql
+
+  @staticmethod
+  def get_param_shape(params, many=False):
+    if many:
+      if not isinstance(params, (list, tuple)): return {'rows': None}
+      first = params[0] if params else []
+      return {'rows': len(params), 'row': StatementMetrics.get_param_shape(first)}
+
+    if isinstance(params, dict):
+      return dict((k, type(v).__name__) for k, v in params.items())
+    if isinstance(params, (list, tuple)):
+      return [type(v).__name__ for v in params]
+    return type(params).__name__
+
+  def record(self, stmt, params, seconds, rowcount, error, many=False):
+    sql = self.normalize_sql(stmt)
+
+    with self.lock:
+      stats = self.statements.get(sql)
+      if stats is None:
+        stats = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0, 'errors': 0,
+          'buckets': [0] * (len(StatementMetrics.BUCKETS) + 1)}
+        self.statements[sql] = stats
+
+      stats['count'] += 1
+      stats['seconds'] += seconds
+      if seconds > stats['max_seconds']: stats['max_seconds'] = seconds
+      # rowcount is -1 for a SELECT, whose rows come from record_fetch
+      if rowcount is not None and rowcount > 0: stats['rows'] += rowcount
+
+      i = 0
+      while i < len(StatementMetrics.BUCKETS) and seconds > StatementMetrics.BUCKETS[i]: i += 1
+      stats['buckets'][i] += 1
+
+      if error is not None:
+        stats['errors'] += 1
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    threshold = self.slow_query_threshold
+    if threshold is not None and seconds >= threshold:
+      entry = {'sql': sql, 'seconds': seconds, 'time': time.time(),
+        'params': StatementMetrics.get_param_shape(params, many)}
+      self.slow_queries.append(entry)
+      if self.log: self.log(entry)
+
+  def record_fetch(self, stmt, count):
+    # count more rows fetched from stmt, after record() has seen it
+    sql = self.normalize_sql(stmt)
+    with self.lock:
+      stats = self.statements.get(sql)
+      if stats is not None: stats['rows'] += count
+
+  def export(self):
+    '''
+    Returns the metrics as a dict:
+    {'statements': {<sql>: {'count', 'seconds', 'max_seconds', 'rows',
+                            'errors', 'buckets': {<le>: <cumulative count>}}},
+     'errors': {<exception class name>: <count>},
+     'slow_queries': [{'sql', 'seconds', 'time', 'params'}, ...]}
+    '''
+    with self.lock:
+      statements = {}
+      for sql, stats in self.statements.items():
+        stats = dict(stats)
+        stats['buckets'] = self.get_cumulative_buckets(stats['buckets'])
+        statements[sql] = stats
+      return {'statements': statements, 'errors': dict(self.errors),
+        'slow_queries': list(self.slow_queries)}
+
+  @staticmethod
+  def get_cumulative_buckets(bucket_counts):
+    bounds = [repr(b) for b in StatementMetrics.BUCKETS] + ['+Inf']
+    cumulative, total = {}, 0
+    for bound, count in zip(bounds, bucket_counts):
+      total += count
+      cumulative[bound] = total
+    return cumulative
+
+  def export_prometheus(self):
+    '''
+    Returns the metrics in the Prometheus text exposition format.
+    '''
+    def label(value):
+      return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    metrics = self.export()
+    lines = ['# HELP dbaccessor_statement_seconds Time spent executing each statement.',
+      '# TYPE dbaccessor_statement_seconds histogram']
+    for sql in sorted(metrics['statements']):
+      stats = metrics['statements'][sql]
+      for bound, count in stats['buckets'].items():
+        lines.append('dbaccessor_statement_seconds_bucket{sql="%s",le="%s"} %d' % (label(sql), bound, count))
+      lines.append('dbaccessor_statement_seconds_sum{sql="%s"} %r' % (label(sql), stats['seconds']))
+      lines.append('dbaccessor_statement_seconds_count{sql="%s"} %d' % (label(sql), stats['count']))
+
+    lines += ['# HELP dbaccessor_statement_rows_total Rows changed or fetched by each statement.',
+      '# TYPE dbaccessor_statement_rows_total counter']
+    for sql in sorted(metrics['statements']):
+      lines.append('dbaccessor_statement_rows_total{sql="%s"} %d' % (label(sql), metrics['statements'][sql]['rows']))
+
+    lines += ['# HELP dbaccessor_errors_total Statement errors by exception class.',
+      '# TYPE dbaccessor_errors_total counter']
+    for name in sorted(metrics['errors']):
+      lines.append('dbaccessor_errors_total{error="%s"} %d' % (label(name), metrics['errors'][name]))
+
+    return '\n'.join(lines) + '\n'
+
+
+
+
+
+
+class ResultCache(object):
+  '''
+  A thread-safe LRU cache of read() results, holding at most maxsize
+  results, each for at most ttl seconds (forever if None). Results of
+  more than max_rows rows are not cached.
+
+  Every table has a generation number that invalidate(table) bumps. A
+  reader takes the generation before running its query and put() drops
+  the result if the table changed in the meantime, so a result read
+  while a write was committing is never cached.
+  '''
+  # one part of a table name: "quoted", `quoted`, [quoted] or bare
+  NAME_PART = r'(?:"[^"]*"|`[^`]*`|\[[^\]]*\]|\w+)'
+
+  def __init__(self, maxsize=1024, ttl=None, max_rows=10000):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.max_rows = max_rows
+    self.lock = threading.Lock()
+    self.entries = collections.OrderedDict()   # key -> (table, rows, expires)
+    self.table_keys = {}                       # table -> set of keys
+    self.generations = {}                      # table -> generation
+    self.epoch = 0                             # bumped by clear()
+    self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'expirations': 0, 'evictions': 0}
+
+  @staticmethod
+  def get_table_key(table):
+    # 'main.s', '"s"' and 'S' all name table s: drop the schema and the
+    # quotes, and lowercase. Writes and reads must agree on this key.
+    parts = re.findall(ResultCache.NAME_PART, table)
+    name = parts[-1] if parts else table
+    if name[:1] in ('"', '`', '['): name = name[1:-1]
+    return name.lower()
+
+  def get_generation(self, table):
+    table = ResultCache.get_table_key(table)
+    with self.lock:
+      return (self.epoch, self.generations.get(table, 0))
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.stats['misses'] += 1
+        return None
+
+      if entry[2] is not None and entry[2] < time.time():
+        self.remove(key)
+        self.stats['expirations'] += 1
+        self.stats['misses'] += 1
+        return None
+
+      self.entries.move_to_end(key)
+      self.stats['hits'] += 1
+      return entry[1]
+
+  def put(self, table, key, rows, generation):
+    if len(rows) > self.max_rows: return
+
+    table = ResultCache.get_table_key(table)
+    expires = None if self.ttl is None else time.time() + self.ttl
+
+    with self.lock:
+      if generation != (self.epoch, self.generations.get(table, 0)): return
+
+      if key in self.entries: self.remove(key)
+      self.entries[key] = (table, rows, expires)
+      self.table_keys.setdefault(table, set()).add(key)
+
+      while len(self.entries) > self.maxsize:
+        self.remove(next(iter(self.entries)))
+        self.stats['evictions'] += 1
+
+  def remove(self, key):
+    # caller holds self.lock
+    table = self.entries.pop(key)[0]
+    keys = self.table_keys.get(table)
+    if keys is not None: keys.discard(key)
+
+  def invalidate(self, table):
+    table = ResultCache.get_table_key(table)
+    with self.lock:
+      self.generations[table] = self.generations.get(table, 0) + 1
+      for key in self.table_keys.pop(table, ()):
+        self.entries.pop(key, None)
+      self.stats['invalidations'] += 1
+
+  def clear(self):
+    with self.lock:
+      self.epoch += 1
+      self.entries.clear()
+      self.table_keys.clear()
+      self.stats['invalidations'] += 1
+
+  def get_stats(self):
+    with self.lock:
+      stats = dict(self.stats)
+      stats['size'] = len(self.entries)
+      stats['maxsize'] = self.maxsize
+      return stats
+
+
+
+
+
+
 class DbAccessor(object):
   '''
   Class to create and execute SQL statements for
   data definition and data manipulation (CRUD). 
   '''
 
+  # PRAGMA settings applied to every connection for each profile= choice.
+  # cache_size is in KiB when negative, mmap_size and busy_timeout are
+  # in bytes and milliseconds.
+  PRAGMA_PROFILES = {
+    'durable': [('journal_mode', 'WAL'), ('synchronous', 'FULL'),
+      ('cache_size', -16000), ('mmap_size', 0), ('temp_store', 'DEFAULT'),
+      ('busy_timeout', 5000)],
+    'fast-write': [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+      ('cache_size', -64000), ('mmap_size', 0), ('temp_store', 'MEMORY'),
+      ('busy_timeout', 5000)],
+    'read-heavy': [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+      ('cache_size', -64000), ('mmap_size', 268435456), ('temp_store', 'MEMORY'),
+      ('busy_timeout', 5000)],
+    'bulk-load': [('journal_mode', 'WAL'), ('synchronous', 'OFF'),
+      ('cache_size', -256000), ('mmap_size', 0), ('temp_store', 'MEMORY'),
+      ('busy_timeout', 30000)],
+  }
+
+  # the table changed by an INSERT, UPDATE, DELETE, DROP TABLE or ALTER TABLE
+  WRITE_TABLE_RE = re.compile(r'\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?'
+    r'|DELETE\s+FROM|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|ALTER\s+TABLE)\s+(%s(?:\s*\.\s*%s)?)'
+    % (ResultCache.NAME_PART, ResultCache.NAME_PART), re.IGNORECASE)
+
   def __init__(self, dbpath, **kwargs):
 
     self.dbpath = dbpath
 
     if not kwargs: kwargs = {}
 
-    default_dict = {'new_db_ok': True, 'verbose': False}
+    default_dict = {'new_db_ok': True, 'verbose': False, 'watch_schema_version': False,
+      'pool_size': None, 'pool_max_idle': None, 'pool_timeout': None,
+      'profile': None, 'pragmas': None, 'stmt_cache_size': 256, 'explain_queries': False,
+      'query_plans_size': 256, 'metrics': False, 'slow_query_threshold': None,
+      'result_cache_size': 0, 'result_cache_ttl': None, 'result_cache_max_rows': 10000,
+      'watch_data_version': False, 'row_format': 'dict', 'validate': False, 'mode': None}
     for k,v in default_dict.items():
       self.__dict__[k] = v if k not in kwargs else kwargs[k]
 
+    # mode='ro' and mode='immutable' open the file read-only (see connect)
+    if self.mode not in (None, 'rw', 'ro', 'immutable'):
+      raise DbAccessorError('bad mode: %s' % self.mode)
+    self.read_only = self.mode in ('ro', 'immutable')
+    if self.read_only and self.dbpath == ':memory:':
+      raise DbAccessorError('mode=%s needs a database file, not :memory:' % self.mode)
+
+
+    self.pragma_list = self.get_pragma_list(self.profile, self.pragmas)
+    DbAccessor.check_row_format(self.row_format)
 
     try:
 
-      if self.new_db_ok:
-        self.conn = sqlite3.connect(self.dbpath)
+      if self.new_db_ok and not self.read_only:
+        self.conn = self.connect()
 
       elif os.path.exists(self.dbpath):
-        self.conn = sqlite3.connect(self.dbpath)
+        self.conn = self.connect()
 
       else:
         raise IOError('Database not found: ' + self.dbpath)
@@ -94,6 +627,55 @@ class DbAccessor(object):
         self.vprint("Exception: Unable to open db file: ", self.dbpath, " detail: ", detail)
         raise
 
+    self.tx_depth = 0
+    self.clear_schema_cache()
+    # explain_queries mode: SQL text -> plan dict, the most recent
+    # query_plans_size statements
+    self.query_plans = StatementCache(self.query_plans_size)
+
+    # objects with a record(stmt, params, seconds, rowcount, error, many)
+    # method, called by try_execute after every statement
+    self.instruments = []
+    if self.metrics:
+      if not isinstance(self.metrics, StatementMetrics):
+        log = lambda entry: self.vprint("slow query: ", entry)
+        self.metrics = StatementMetrics(self.slow_query_threshold, log)
+      self.add_instrument(self.metrics)
+
+    # most values a single statement may bind
+    getlimit = getattr(self.conn, 'getlimit', None)
+    if getlimit is None:
+      self.max_variables = 999
+    else:
+      self.max_variables = getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+
+    self.stmt_cache = None
+    if self.stmt_cache_size:
+      self.stmt_cache = StatementCache(self.stmt_cache_size)
+
+    self.result_cache = None
+    self.tx_tables = set()
+    self.data_versions = {}
+    if self.result_cache_size:
+      self.result_cache = ResultCache(self.result_cache_size, self.result_cache_ttl,
+        self.result_cache_max_rows)
+
+    # pooled mode: self.conn is the single writer connection, guarded by
+    # write_lock, and reads borrow a connection from a pool of readers
+    self.pool = None
+    self.write_lock = None
+    self.local = threading.local()
+
+    if self.pool_size:
+      if self.dbpath == ':memory:':
+        self.conn.close()
+        raise DbAccessorError('a connection pool needs a database file, not :memory:')
+
+      if not self.read_only: self.conn.execute('PRAGMA journal_mode = WAL')
+      self.write_lock = threading.RLock()
+      self.pool = ConnectionPool(lambda: self.connect(read_only=True),
+        self.pool_size, self.pool_max_idle, self.pool_timeout)
+
 
 
 
@@ -106,80 +688,617 @@ class DbAccessor(object):
       print(s) 
 
 
+  def connect(self, read_only=False):
+    '''
+    Opens a new connection to dbpath. In pooled mode connections
+    may be used from any thread, and read_only connections refuse
+    to write (PRAGMA query_only).
+
+    With mode='ro' the file is opened through a file: URI with
+    mode=ro, so sqlite never creates or writes it. mode='immutable'
+    adds immutable=1: sqlite takes no locks and skips change
+    detection, which is only safe for files nobody writes while they
+    are open (e.g. published snapshots).
+    '''
+    # keep sqlite3's own prepared statement cache at least as large
+    # as the SQL text cache, so cached SQL is also already compiled
+    cached_statements = max(128, self.stmt_cache_size or 0)
+
+    dbpath, uri = self.dbpath, False
+    if self.read_only:
+      dbpath = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(self.dbpath))
+      if self.mode == 'immutable': dbpath += '&immutable=1'
+      uri = True
+
+    conn = sqlite3.connect(dbpath, check_same_thread=not self.pool_size,
+      cached_statements=cached_statements, uri=uri)
+
+    for name, value in self.pragma_list:
+      # the journal mode is stored in the file, so it cannot be set read-only
+      if self.read_only and name == 'journal_mode': continue
+      conn.execute('PRAGMA %s = %s' % (name, value))
+
+    if read_only: conn.execute('PRAGMA query_only = 1')
+    return conn
+
+
+  @staticmethod
+  def get_pragma_list(profile=None, pragmas=None):
+    '''
+    Returns the [(<pragma name>, <value>), ...] list for a profile name
+    (a key of PRAGMA_PROFILES, or None), with pragmas -- a dict or list
+    of (name, value) pairs -- applied on top of it.
+    '''
+    if profile is None:
+      pragma_list = []
+    elif profile in DbAccessor.PRAGMA_PROFILES:
+      pragma_list = list(DbAccessor.PRAGMA_PROFILES[profile])
+    else:
+      raise DbAccessorError('bad profile: %s' % profile)
+
+    if pragmas:
+      if isinstance(pragmas, dict): pragmas = sorted(pragmas.items())
+
+      for name, value in pragmas:
+        if not str(name).replace('_', '').isalnum():
+          raise DbAccessorError('bad pragma name: %s' % name)
+        if not str(value).lstrip('-').replace('_', '').isalnum():
+          raise DbAccessorError('bad pragma value: %s' % value)
+
+        pragma_list = [(n, v) for n, v in pragma_list if n != name]
+        pragma_list.append((name, value))
+
+    return pragma_list
+
+
+  def get_pragmas(self, names=None):
+    '''
+    Returns a dict of the effective values of the named PRAGMAs on the
+    main connection. By default reports the settings that the profiles
+    control (journal_mode, synchronous, cache_size, mmap_size,
+    temp_store, busy_timeout) plus any extra pragmas passed in.
+    '''
+    if names is None:
+      names = [name for name, _ in DbAccessor.PRAGMA_PROFILES['durable']]
+      names += [name for name, _ in self.pragma_list if name not in names]
+
+    settings = {}
+    with self.borrow(write=True) as conn:
+      for name in names:
+        row = conn.execute('PRAGMA %s' % name).fetchone()
+        settings[name] = row[0] if row else None
+
+    return settings
+
+
   def close(self):
+    if self.pool is not None: self.pool.close()
     self.conn.close()
 
 
+  def check_writable(self):
+    # called by the methods that write, so a read-only accessor fails
+    # before any SQL is built
+    if self.read_only:
+      raise DbAccessorError('database %s is read-only (mode=%s)' % (self.dbpath, self.mode))
+
+  def get_pool_stats(self):
+    '''
+    Returns a dict of connection pool statistics (checkouts, waits,
+    timeouts, opened, evicted, affinity_hits, peak_in_use, size, open,
+    idle, in_use), or None when the accessor is not pooled.
+    '''
+    if self.pool is None: return None
+    return self.pool.get_stats()
+
+
 
   def display_table(self, table, title="table"):
 
     print ("\n---------  %s  ---------------\n" % title)
     for row in self.read(table): print(row)
 
+  #---------- Instrumentation ------------------------------
+
+  def add_instrument(self, instrument):
+    '''
+    Adds an object whose record(stmt, params, seconds, rowcount, error,
+    many) method is called after every statement try_execute runs.
+    rowcount is the cursor's rowcount (-1 for SELECT, None on error)
+    and error is the exception raised, or None. If the object also has
+    a record_fetch(stmt, count) method, it is called with the number of
+    rows the read methods fetch from each SELECT.
+    '''
+    self.instruments.append(instrument)
+
+  def remove_instrument(self, instrument):
+    self.instruments.remove(instrument)
+
+  def record_statement(self, stmt, params, seconds, cursor, error, many=False):
+    rowcount = None if cursor is None else cursor.rowcount
+    for instrument in self.instruments:
+      instrument.record(stmt, params, seconds, rowcount, error, many)
+
+  def record_fetch(self, stmt, row_list):
+    # rows a read method fetched from stmt; returns row_list
+    for instrument in self.instruments:
+      record_fetch = getattr(instrument, 'record_fetch', None)
+      if record_fetch is not None: record_fetch(stmt, len(row_list))
+    return row_list
+
+  def get_metrics(self, format='dict'):
+    '''
+    Returns the metrics collected when the accessor was opened with
+    metrics=True, as a dict (format='dict') or as Prometheus text
+    (format='prometheus'). See StatementMetrics.export.
+    '''
+    if not self.metrics:
+      raise DbAccessorError('metrics are not enabled')
+
+    if format == 'dict': return self.metrics.export()
+    if format == 'prometheus': return self.metrics.export_prometheus()
+    raise DbAccessorError('bad metrics format: %s' % format)
+
   #---------- execute within context  ----------------------
 
+  @staticmethod
+  def is_write_stmt(stmt):
+    # used in pooled mode to send a statement to the writer connection
+    words = stmt.split(None, 1)
+    if not words: return False
+
+    verb = words[0].upper()
+    if verb in ('SELECT', 'WITH', 'EXPLAIN', 'VALUES'): return False
+    if verb == 'PRAGMA': return '=' in stmt
+    return True
+
+  @contextlib.contextmanager
+  def borrow(self, write=False):
+    '''
+    Context manager that yields the connection to run statements on.
+
+    Without a pool this is always self.conn. In pooled mode a write
+    gets the writer connection (one thread at a time) and a read gets
+    a connection checked out of the reader pool; both are given back
+    when the with block exits. Nested borrows on the same thread reuse
+    the outer connection, so reads inside a transaction see its writes.
+
+    In pooled mode a cursor returned by execute is only safe to use
+    inside a borrow block:
+
+    with db.borrow() as conn:
+      rows = db.execute(stmt, params).fetchall()
+    '''
+    if self.pool is None:
+      yield self.conn
+      return
+
+    held = getattr(self.local, 'conn', None)
+    if held is not None and (held is self.conn or not write):
+      yield held
+      return
+
+    if write:
+      self.write_lock.acquire()
+      conn = self.conn
+    else:
+      conn = self.pool.checkout()
+
+    self.local.conn = conn
+    try:
+      yield conn
+    finally:
+      self.local.conn = held
+      if write:
+        self.write_lock.release()
+      else:
+        self.pool.checkin(conn)
+
   def execute(self, stmt, params=[]):
-    return self.try_execute(self.conn.execute, stmt, params)
+    if self.explain_queries: self.log_query_plan(stmt, params)
+
+    if self.pool is None:
+      return self.try_execute(self.conn.execute, stmt, params)
+
+    with self.borrow(DbAccessor.is_write_stmt(stmt)) as conn:
+      return self.try_execute(conn.execute, stmt, params, conn)
 
   def executemany(self, stmt, params=[]):
-    return self.try_execute(self.conn.executemany, stmt, params)
+    if self.pool is None:
+      return self.try_execute(self.conn.executemany, stmt, params)
 
-  def try_execute(self, execute, stmt, params=[]):
+    with self.borrow(write=True) as conn:
+      return self.try_execute(conn.executemany, stmt, params, conn)
+
+  def try_execute(self, execute, stmt, params=[], conn=None):
     if params == None: params=[]
+    if conn is None: conn = self.conn
+
+    start = time.perf_counter() if self.instruments else None
 
     try:
-      
-      with self.conn:
-        result = execute(stmt, params)
+      try:
+
+        if self.tx_depth and conn is self.conn:
+          # inside db.transaction(): commit or rollback happens when it exits
+          result = execute(stmt, params)
+        else:
+          with conn:
+            result = execute(stmt, params)
+
+      except sqlite3.OperationalError as error:
+        self.vprint("execute sqlite OperationalError: ", error)
+        raise
+      except sqlite3.DatabaseError as error:
+        self.vprint("execute sqlite DatabaseError: ", error)
+        raise
+      except sqlite3.IntegrityError as error:
+        self.vprint("execute sqlite IntegrityError: ", error)
+        raise
+      except sqlite3.ProgrammingError as error:
+        self.vprint("execute sqlite ProgrammingError: ", error)
+        raise
+      except sqlite3.Error as error:
+        self.vprint("execute sqlite Error: ", error)
+        raise
+      except Exception as error:
+        self.vprint("execute Exception Error: ", error)
+        raise
 
-    except sqlite3.OperationalError as error:
-      self.vprint("execute sqlite OperationalError: ", error)
-      raise
-    except sqlite3.DatabaseError as error:
-      self.vprint("execute sqlite DatabaseError: ", error)
-      raise
-    except sqlite3.IntegrityError as error:
-      self.vprint("execute sqlite IntegrityError: ", error)
-      raise
-    except sqlite3.ProgrammingError as error:
-      self.vprint("execute sqlite ProgrammingError: ", error)
-      raise
-    except sqlite3.Error as error:
-      self.vprint("execute sqlite Error: ", error)
-      raise
     except Exception as error:
-      self.vprint("execute Exception Error: ", error)
+      if self.result_cache is not None: self.note_write(stmt)
+      if start is not None:
+        self.record_statement(stmt, params, time.perf_counter() - start, None, error,
+          getattr(execute, '__name__', None) == 'executemany')
       raise
 
+    if self.result_cache is not None: self.note_write(stmt)
+
+    if start is not None:
+      self.record_statement(stmt, params, time.perf_counter() - start, result, None,
+        getattr(execute, '__name__', None) == 'executemany')
+
     return(result)
 
   def get_row_list_with_execute(self, stmt, params=[]):
-    result = self.execute(stmt, params)
-    return [row for row in result]
+    with self.borrow(DbAccessor.is_write_stmt(stmt)):
+      result = self.execute(stmt, params)
+      return [row for row in result]
 
   def get_row_list_with_executemany(self, stmt, params=[]):
-    result = self.executemany(stmt, params)
-    return [row for row in result]
+    with self.borrow(write=True):
+      result = self.executemany(stmt, params)
+      return [row for row in result]
+
+
+
+  #---------- Query Plans ----------------------------------
+
+  def explain_stmt(self, stmt, params=[]):
+    '''
+    Runs EXPLAIN QUERY PLAN on stmt and returns a dict:
+
+    'sql'         -- stmt
+    'plan'        -- list of {'id', 'parent', 'detail'} steps
+    'scans'       -- details of steps that read a whole table, either
+                     directly ('SCAN stocks') or in the order of an
+                     index ('SCAN stocks USING INDEX ...'), as opposed
+                     to SEARCH steps that look rows up in an index
+    'temp_btrees' -- details of steps that sort or de-duplicate rows in
+                     a temporary b-tree (an ORDER BY no index covers)
+    '''
+    rows = self.get_row_list_with_execute("EXPLAIN QUERY PLAN " + stmt, params)
+    plan = [{'id': row[0], 'parent': row[1], 'detail': row[-1]} for row in rows]
+
+    scans = [step['detail'] for step in plan if step['detail'].startswith('SCAN')]
+    temp_btrees = [step['detail'] for step in plan if 'TEMP B-TREE' in step['detail']]
+
+    return {'sql': stmt, 'plan': plan, 'scans': scans, 'temp_btrees': temp_btrees}
+
+
+  def explain(self, table, columns=None, where_row_list=None, sort_cols=None, set_row=None, kind='select'):
+    '''
+    Shows how sqlite would run a read (kind='select'), update or delete
+    with these arguments, and suggests an index when it would scan the
+    whole table or sort rows in a temporary b-tree.
+
+    Returns the dict from explain_stmt plus 'suggestions', a list of
+    {'table', 'index_field_name', 'unique', 'call'} dicts, where call is
+    the create_index call that would help, e.g.
+    "db.create_index('stocks', ['industry', 'price'], unique=False)"
+    '''
+    if kind not in ('select', 'update', 'delete'):
+      raise DbAccessorError('bad explain kind: %s' % kind)
+
+    # a long IN list is split as read, update and delete split it, and
+    # every chunk is run with the same plan: explain the first one
+    max_values = self.max_variables - (len(set_row) if kind == 'update' else 0)
+    where_chunk = DbAccessor.split_where_in(where_row_list, max_values)[0]
+
+    if kind == 'select':
+      (stmt, value_list) = DbAccessor.mkselect(table, columns, where_chunk, sort_cols)
+    elif kind == 'update':
+      (stmt, value_list) = DbAccessor.mkupdate(table, set_row, where_chunk)
+    else:
+      (stmt, value_list) = DbAccessor.mkdelete(table, where_chunk)
+
+    result = self.explain_stmt(stmt, value_list)
+    if kind != 'select': sort_cols = None
+
+    # columns compared with = (or IN / IS NULL) go first in an index,
+    # then at most one range column, otherwise the sort columns
+    eq_ops = ('=', 'IN', 'IS NULL')
+    range_ops = ('>', '<', '>=', '<=', 'BETWEEN')
+    eq_cols, range_cols = [], []
+    for col in where_row_list or []:
+      if DbAccessor.is_or_group(col) or not isinstance(col[1], str): continue
+      op = col[1].upper()
+      if op in eq_ops and col[0] not in eq_cols: eq_cols.append(col[0])
+      elif op in range_ops and col[0] not in range_cols: range_cols.append(col[0])
+
+    index_list = []
+    if result['scans'] and (eq_cols or range_cols):
+      index_list.append(eq_cols + range_cols[:1])
+    if result['temp_btrees'] and sort_cols:
+      sort_index = list(eq_cols)
+      for col_name, sort_type in sort_cols:
+        if col_name in sort_index: continue
+        sort_index.append(col_name if sort_type.upper() == 'ASC' else (col_name, 'DESC'))
+      if sort_index not in index_list: index_list.append(sort_index)
+
+    # an index whose columns lead another suggestion (or repeat an
+    # earlier one) is not needed: sqlite can use the other one for it
+    names_list = [[col_name for col_name, _ in DbAccessor.get_index_col_list(index)] for index in index_list]
+    index_list = [index for i, (index, names) in enumerate(zip(index_list, names_list))
+      if not any(j != i and other[:len(names)] == names and (len(other) > len(names) or j < i)
+        for j, other in enumerate(names_list))]
+
+    suggestions = []
+    for index_field_name in index_list:
+      call = "db.create_index(%r, %r, unique=False)" % (table, index_field_name)
+      suggestions.append({'table': table, 'index_field_name': index_field_name,
+        'unique': False, 'call': call})
+
+    result['suggestions'] = suggestions
+    return result
+
+
+  def log_query_plan(self, stmt, params=[]):
+    # explain_queries mode: the first time a SELECT, UPDATE or DELETE is
+    # executed its plan is stored in query_plans, and a plan with a full
+    # table scan or temp b-tree is reported with vprint or passed to
+    # explain_queries when that is a callable. A statement that could
+    # not be explained is stored as False.
+    if self.query_plans.get(stmt) is not None: return
+
+    words = stmt.split(None, 1)
+    if not words or words[0].upper() not in ('SELECT', 'UPDATE', 'DELETE', 'WITH'): return
+
+    self.query_plans.put(stmt, False)
+    try:
+      plan = self.explain_stmt(stmt, params)
+    except sqlite3.Error:
+      return
+    self.query_plans.put(stmt, plan)
+
+    if plan['scans'] or plan['temp_btrees']:
+      self.vprint("query plan: ", plan)
+      if callable(self.explain_queries): self.explain_queries(plan)
+
+
+  def get_query_plans(self):
+    '''
+    Returns {<sql>: <plan dict>} for the most recent statements seen in
+    explain_queries mode, at most query_plans_size of them (see
+    explain_stmt for the plan dict).
+    '''
+    return dict((stmt, plan) for stmt, plan in self.query_plans.items() if plan)
+
+
+  #---------- Transactions ---------------------------------
+
+  @contextlib.contextmanager
+  def transaction(self, mode=None):
+    '''
+    Context manager that groups statements into one transaction.
+
+    with db.transaction():
+      db.insert('stocks', values)
+      db.update('stocks', set_row, where_row_list)
+
+    Statements executed inside the with block are not committed one
+    at a time; they are committed once when the block exits, or rolled
+    back if the block raises.
+
+    mode (optional) -- 'DEFERRED', 'IMMEDIATE' or 'EXCLUSIVE', used for
+                       the BEGIN statement of the outermost transaction.
+
+    Nested transaction() blocks use SAVEPOINTs, so an exception in an
+    inner block only rolls back the inner block's work. In pooled mode
+    other threads wait for the block to finish before they can write.
+    '''
+    valid_modes = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+    if mode is not None and mode.upper() not in valid_modes:
+      raise DbAccessorError('bad transaction mode: %s' % mode)
+
+    # in pooled mode the writer connection is held for the whole block
+    with self.borrow(write=True):
+      savepoint = None
+      if self.tx_depth:
+        savepoint = 'dbaccessor_sp_%d' % self.tx_depth
+        begin = 'SAVEPOINT ' + savepoint
+      elif mode:
+        begin = 'BEGIN ' + mode.upper()
+      else:
+        begin = 'BEGIN'
+
+      self.tx_depth += 1
+      try:
+        self.execute(begin)
+      except Exception:
+        self.tx_depth -= 1
+        raise
+
+      try:
+        yield self
+
+      except BaseException:
+        self.tx_depth -= 1
+        if savepoint:
+          self.execute('ROLLBACK TO ' + savepoint)
+          self.execute('RELEASE ' + savepoint)
+        else:
+          self.conn.rollback()
+        self.invalidate_tx_tables(reset=not savepoint)
+        raise
+
+      self.tx_depth -= 1
+      if savepoint:
+        self.execute('RELEASE ' + savepoint)
+      else:
+        try:
+          self.conn.commit()
+        except Exception:
+          self.conn.rollback()
+          raise
+        finally:
+          self.invalidate_tx_tables(reset=True)
+
+
+  #---------- Result Cache ---------------------------------
+
+  def note_write(self, stmt):
+    # drops cached read() results for the table a statement changed.
+    # Tables changed by triggers or foreign key actions are not seen;
+    # call clear_result_cache() if you rely on those.
+    words = stmt.split(None, 1)
+    if not words: return
+
+    verb = words[0].upper()
+    if verb not in ('INSERT', 'REPLACE', 'UPDATE', 'DELETE', 'DROP', 'ALTER'): return
+
+    match = DbAccessor.WRITE_TABLE_RE.match(stmt)
+    if match is None:
+      self.clear_result_cache()
+      return
+
+    table = ResultCache.get_table_key(match.group(1))
+    self.result_cache.invalidate(table)
+    if self.tx_depth: self.tx_tables.add(table)
+
+  def invalidate_tx_tables(self, reset):
+    # a transaction's writes become visible (commit) or disappear
+    # (rollback) when it ends: drop anything read meanwhile
+    if self.result_cache is not None:
+      for table in self.tx_tables: self.result_cache.invalidate(table)
+    if reset: self.tx_tables = set()
+
+  def check_data_version(self, conn):
+    # PRAGMA data_version changes when another connection commits;
+    # an immutable file never changes
+    if self.mode == 'immutable': return
+
+    version = conn.execute('PRAGMA data_version').fetchone()[0]
+    last_version = self.data_versions.get(id(conn))
+    self.data_versions[id(conn)] = version
+    if last_version != version: self.result_cache.clear()
+
+  def clear_result_cache(self):
+    if self.result_cache is not None: self.result_cache.clear()
+
+  def get_result_cache_stats(self):
+    '''
+    Returns a dict with the result cache's hits, misses, invalidations,
+    expirations, evictions, size and maxsize, or None if it is off.
+    '''
+    if self.result_cache is None: return None
+    return self.result_cache.get_stats()
+
+  def read_cached(self, table, columns, stmt, value_list, row_format='dict'):
+    # dict rows are cached as tuples and copied out on every hit; the
+    # other row formats are immutable and are cached as they are
+    cache_format = 'tuple' if row_format == 'dict' else row_format
+    key = (stmt, tuple(value_list), cache_format)
+
+    with self.borrow() as conn:
+      if self.watch_data_version: self.check_data_version(conn)
+
+      # a read inside transaction() sees its uncommitted writes, and a
+      # table it wrote is not settled until it commits or rolls back:
+      # neither may go into the cache shared with other threads
+      in_tx = self.tx_depth and conn is self.conn
+      row_list = None if in_tx else self.result_cache.get(key)
+      if row_list is None:
+        generation = self.result_cache.get_generation(table)
+        cur = self.execute(stmt, value_list)
+        row_list = self.record_fetch(stmt, self.fetch_rows(cur, columns, cache_format))
+        if not in_tx and ResultCache.get_table_key(table) not in self.tx_tables:
+          self.result_cache.put(table, key, row_list, generation)
 
+    if row_format == 'dict': return DbAccessor.convert_rows(columns, row_list, 'dict')
+    return list(row_list)
+
+
+  #---------- Schema Cache ---------------------------------
+
+  def clear_schema_cache(self):
+    '''
+    Forgets all cached table names, field names and field types.
+    The create/drop table and create/drop index methods call this
+    for you. Call it yourself after changing the schema with a raw
+    execute, or construct the accessor with watch_schema_version=True.
+    '''
+    self.table_names_cache = None
+    self.field_names_cache = {}
+    self.field_name_type_cache = {}
+    self.dbschema_detail_cache = None
+    self.schema_version = None
+    self.validator = None
+    self.validator_version = None
+    self.validated_shapes = set()
+
+  def check_schema_version(self):
+    # When watch_schema_version is on, compare sqlite's schema cookie
+    # with the one seen when the cache was filled. Any schema change,
+    # by this connection or another one, bumps the cookie.
+    if not self.watch_schema_version or self.read_only: return
+
+    version = self.get_row_list_with_execute("PRAGMA schema_version")[0][0]
+    if version != self.schema_version:
+      self.clear_schema_cache()
+      self.schema_version = version
 
 
   #---------- Schema Examination Methods -------------------
 
   def get_table_names(self):
-    rows = self.execute("select name from sqlite_master where type = 'table' ")
-    return [row[0] for row in rows]
+    self.check_schema_version()
+
+    if self.table_names_cache is None:
+      rows = self.get_row_list_with_execute("select name from sqlite_master where type = 'table' ")
+      self.table_names_cache = [row[0] for row in rows]
+
+    return list(self.table_names_cache)
 
 
   def get_index_names(self):
-    rows = self.execute("select name from sqlite_master where type = 'index' ")
+    rows = self.get_row_list_with_execute("select name from sqlite_master where type = 'index' ")
     return [row[0] for row in rows]
 
 
   def get_field_names(self, table_name):
-    cur = self.execute("select * from %s limit 0" % table_name)
-    field_names = [desc[0] for desc in cur.description]
-    cur.close()
-    return(field_names)
+    # the name goes into SQL below, so validate mode checks it first
+    if self.validate: self.check_query(('table', table_name), table_name)
+    self.check_schema_version()
+
+    if table_name not in self.field_names_cache:
+      with self.borrow():
+        cur = self.execute("select * from %s limit 0" % table_name)
+        self.field_names_cache[table_name] = [desc[0] for desc in cur.description]
+        cur.close()
+
+    return list(self.field_names_cache[table_name])
 
   def get_field_name_type_list(self, table_name):
     '''
@@ -192,10 +1311,14 @@ class DbAccessor(object):
     (u'id', u'integer')
     '''
 
-    cur = self.execute("PRAGMA table_info(%s)" % table_name)
-    field_name_type_list = [(row[1], row[2]) for row in cur]
-    cur.close()
-    return field_name_type_list
+    if self.validate: self.check_query(('table', table_name), table_name)
+    self.check_schema_version()
+
+    if table_name not in self.field_name_type_cache:
+      rows = self.get_row_list_with_execute("PRAGMA table_info(%s)" % table_name)
+      self.field_name_type_cache[table_name] = [(row[1], row[2]) for row in rows]
+
+    return list(self.field_name_type_cache[table_name])
 
   def get_create_sql_dict(self):
     #returns dict in this form:
@@ -203,7 +1326,7 @@ class DbAccessor(object):
     #create_sql_stmt looks like this
     #create_sql_stmt = 'CREATE TABLE stocks (id integer primary key autoincrement not null, \
     #ticker text unique, industry text, beta numeric, price numeric)'
-    rows = self.execute("select name, sql from sqlite_master where type='table'")
+    rows = self.get_row_list_with_execute("select name, sql from sqlite_master where type='table'")
 
     create_sql_dict = {}
     for row in rows:
@@ -230,16 +1353,95 @@ class DbAccessor(object):
 
 
   def get_dbschema(self):
+    dbschema_detail = self.get_dbschema_detail()
+
+    # built from the one cached query alone, so tables and columns agree
     dbschema = {}
-    for tn in self.get_table_names(): 
-      dbschema[tn] = self.get_field_name_type_list(tn)
+    for tn, table_detail in dbschema_detail.items(): 
+      dbschema[tn] = [(col['name'], col['type']) for col in table_detail['columns']]
     return(dbschema) 
 
+  def get_dbschema_detail(self):
+    '''
+    returns the columns and indexes of every table, read with two
+    queries however many tables there are:
+
+    {<table_name>: {
+      'columns': [{'name': .., 'type': .., 'notnull': .., 'default': .., 'pk': ..}, ...],
+      'indexes': [{'name': .., 'unique': .., 'origin': .., 'partial': .., 'columns': [..]}, ...]},
+     ...}
+
+    pk is the column's position in the primary key (0 if not part of
+    it); origin is 'c' (create index), 'u' (unique) or 'pk'. Expression
+    index columns are None. The result is kept in the schema cache and
+    also fills the get_field_name_type_list cache.
+    '''
+
+    self.check_schema_version()
+
+    if self.dbschema_detail_cache is None:
+      with self.borrow():
+        column_rows = self.get_row_list_with_execute(
+          "SELECT m.name, p.name, p.type, p.\"notnull\", p.dflt_value, p.pk "
+          "FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p "
+          "WHERE m.type = 'table' ORDER BY m.name, p.cid")
+
+        index_rows = self.get_row_list_with_execute(
+          "SELECT m.name, il.name, il.\"unique\", il.origin, il.partial, ii.name "
+          "FROM sqlite_master AS m JOIN pragma_index_list(m.name) AS il "
+          "JOIN pragma_index_info(il.name) AS ii "
+          "WHERE m.type = 'table' ORDER BY m.name, il.seq, ii.seqno")
+
+      dbschema_detail = {}
+      for tn, name, field_type, notnull, default, pk in column_rows:
+        table_detail = dbschema_detail.setdefault(tn, {'columns': [], 'indexes': []})
+        table_detail['columns'].append({'name': name, 'type': field_type, 'notnull': bool(notnull),
+          'default': default, 'pk': pk})
+
+      for tn, index_name, unique, origin, partial, col_name in index_rows:
+        index_list = dbschema_detail[tn]['indexes']
+        if not index_list or index_list[-1]['name'] != index_name:
+          index_list.append({'name': index_name, 'unique': bool(unique), 'origin': origin,
+            'partial': bool(partial), 'columns': []})
+        index_list[-1]['columns'].append(col_name)
+
+      for tn, table_detail in dbschema_detail.items():
+        self.field_name_type_cache[tn] = [(col['name'], col['type']) for col in table_detail['columns']]
+
+      self.dbschema_detail_cache = dbschema_detail
+
+    return self.dbschema_detail_cache
+
 
   def get_db_validator(self):
     dbschema = self.get_dbschema() 
     return DbSchemaValidator(dbschema) 
 
+  def check_query(self, shape, table, columns=None, where_row_list=None, sort_cols=None):
+    '''
+    With validate=True, the statement builders (and get_field_names and
+    get_field_name_type_list) call this before putting table and column
+    names into SQL. A shape (the statement cache key)
+    is validated once; on a new shape the validator is rebuilt first if
+    PRAGMA schema_version moved since it was built. Raises
+    DbSchemaValidatorError for an unknown name.
+    '''
+    if shape in self.validated_shapes: return
+
+    # a read-only accessor builds its validator once
+    if self.read_only and self.validator is not None:
+      version = self.validator_version
+    else:
+      version = self.get_row_list_with_execute("PRAGMA schema_version")[0][0]
+
+    if self.validator is None or version != self.validator_version:
+      self.clear_schema_cache()
+      self.validator = self.get_db_validator()
+      self.validator_version = version
+
+    self.validator.validate_query(table, columns, where_row_list, sort_cols)
+    self.validated_shapes.add(shape)
+
   def get_dbschema_json_str(self):
     return json.dumps(self.get_dbschema(), indent=4,sort_keys=True)
 
@@ -265,76 +1467,422 @@ class DbAccessor(object):
     then an index will be created
     """
 
+    self.check_writable()
+
     fnt_list = ["%s %s" % (fn, ft) for fn, ft in field_names_types]
     fntypes = ", ".join(fnt_list)
 
     stmt = "create table if not exists %s (%s)" % (table_name, fntypes)
     self.execute(stmt)
+    self.clear_schema_cache()
 
 
   def drop_table(self, table_name):
+    self.check_writable()
     stmt = "drop table if exists %s" % table_name
     self.execute(stmt)
+    self.clear_schema_cache()
 
 
   @staticmethod
-  def create_index_name(table_name, index_field_name):
-    return "%s_%s_index" % (table_name, index_field_name)
+  def get_index_col_list(index_field_name):
+    # index_field_name may be a column name, or a list of column names
+    # and ('<column>', 'ASC'|'DESC') pairs
+    if isinstance(index_field_name, str): return [(index_field_name, None)]
+
+    col_list = []
+    for col in index_field_name:
+      if isinstance(col, str):
+        col_list.append((col, None))
+      elif col[1].upper() in ('ASC', 'DESC'):
+        col_list.append((col[0], col[1].upper()))
+      else:
+        raise DbAccessorError('bad sort type %s' % col[1])
 
+    if not col_list:
+      raise DbAccessorError('no index columns')
+    return col_list
 
-  def create_index(self, table_name, index_field_name):
-    index_name = DbAccessor.create_index_name(table_name, index_field_name)
-    stmt = "create unique index %s on %s(%s)" % (index_name, table_name, index_field_name)
 
-    self.execute(stmt)
+  @staticmethod
+  def create_index_name(table_name, index_field_name):
+    col_names = [col_name for col_name, _ in DbAccessor.get_index_col_list(index_field_name)]
+    return "%s_%s_index" % (table_name, '_'.join(col_names))
 
 
+  @staticmethod
+  def sql_literal(value):
+    # partial index WHERE clauses can not use bound parameters
+    if value is None: return 'NULL'
+    if isinstance(value, bool): return str(int(value))
+    if isinstance(value, (int, float)): return repr(value)
+    if isinstance(value, str): return "'" + value.replace("'", "''") + "'"
+    if isinstance(value, (bytes, bytearray)): return "X'" + bytes(value).hex() + "'"
+    raise DbAccessorError('can not write %r into SQL' % (value,))
 
-  def drop_index(self, table_name, index_field_name):
-    index_name = DbAccessor.create_index_name(table_name, index_field_name)
-    stmt = "drop index if exists %s" % index_name
 
-    self.execute(stmt)
+  @staticmethod
+  def mkcreate_index(table_name, index_field_name, unique=True, where_row_list=None,
+      if_not_exists=False, include_cols=None, index_name=None):
 
+    col_list = DbAccessor.get_index_col_list(index_field_name)
+    if include_cols:
+      col_list += [(col_name, None) for col_name in include_cols]
 
+    if not index_name: index_name = DbAccessor.create_index_name(table_name, index_field_name)
 
-  #---------  Data Access Methods (CRUD) -------------------
+    stmt = "create unique index " if unique else "create index "
+    if if_not_exists: stmt += "if not exists "
+    stmt += "%s on %s(%s)" % (index_name, table_name,
+      ', '.join([col_name if not sort_type else col_name + ' ' + sort_type for col_name, sort_type in col_list]))
 
-  @staticmethod
-  def get_dict_kv_lists(dict_table):
-    klst, vlst = [],[]
-    for k,v in dict_table.items():
-      klst.append(k)
-      vlst.append(v)
-    return(klst, vlst)    
+    if where_row_list:
+      (where_clause, value_list) = DbAccessor.mk_where_clause(where_row_list)
+      parts = where_clause.split('?')
+      where_clause = parts[0]
+      for value, part in zip(value_list, parts[1:]):
+        where_clause += DbAccessor.sql_literal(value) + part
+      stmt += where_clause
 
-  @staticmethod
-  def mkupdate(table, set_row, where_row_list):
+    return stmt
 
-    (set_key_list, value_list) = DbAccessor.get_dict_kv_lists(set_row)
 
+  def create_index(self, table_name, index_field_name, unique=True, where_row_list=None,
+      if_not_exists=False, include_cols=None, index_name=None):
+    '''
+    Creates an index on table_name.
 
-    stmt = 'UPDATE ' + table + " \n"
-    stmt += "SET "
-    stmt += ', '.join([k + ' = ' + '?'  for k in set_key_list])
+    Arguments:
+    table_name      -- name of the table to be indexed
+    index_field_name -- a column name, or a list of column names and
+                       ('<column>', 'ASC'|'DESC') pairs for a composite
+                       index, e.g. ['industry', ('price', 'DESC')]
+
+    unique (optional)         -- create a unique index (the default);
+                                 use unique=False for columns with
+                                 duplicate values, like industry
+    where_row_list (optional) -- makes a partial index that only holds
+                                 the rows matching where_row_list; the
+                                 values are written into the SQL
+    if_not_exists (optional)  -- do nothing if the index already exists
+    include_cols (optional)   -- extra columns added at the end of the
+                                 index so that queries reading only
+                                 indexed columns never touch the table
+                                 (a covering index)
+    index_name (optional)     -- defaults to create_index_name(...)
+    '''
+    self.check_writable()
+    stmt = DbAccessor.mkcreate_index(table_name, index_field_name, unique, where_row_list,
+      if_not_exists, include_cols, index_name)
 
-    (where_clause, where_value_list) = DbAccessor.mk_where_clause(where_row_list)
-    stmt += where_clause
-    stmt += ";"
+    self.execute(stmt)
+    self.clear_schema_cache()
 
-    value_list.extend(where_value_list)
 
-    return(stmt, value_list)
+
+  def drop_index(self, table_name, index_field_name, index_name=None):
+    self.check_writable()
+    if not index_name: index_name = DbAccessor.create_index_name(table_name, index_field_name)
+    stmt = "drop index if exists %s" % index_name
+
+    self.execute(stmt)
+    self.clear_schema_cache()
+
+
+  def analyze(self, table_name=None, optimize=True):
+    '''
+    Gathers statistics about tables and indexes so the query planner
+    can choose between indexes: runs ANALYZE (on table_name only, if
+    given) and then, if optimize is True, PRAGMA optimize.
+    '''
+    self.check_writable()
+    if table_name:
+      self.execute("ANALYZE %s" % table_name)
+    else:
+      self.execute("ANALYZE")
+
+    if optimize: self.execute("PRAGMA optimize")
+
+
+
+  #---------  Statement Cache ------------------------------
+
+  @staticmethod
+  def get_where_shape(where_row_list):
+    # the part of a where_row_list that decides the SQL text
+    if not where_row_list: return ()
+
+    shape = []
+    for col in where_row_list:
+      if DbAccessor.is_or_group(col):
+        shape.append(('OR', tuple(DbAccessor.get_where_shape(sub) for sub in col[1])))
+      elif len(col) == 3 and isinstance(col[1], str) and col[1].upper() in ('IN', 'NOT IN'):
+        shape.append((col[0], col[1], 3, len(col[2])))
+      else:
+        shape.append((col[0], col[1], len(col)))
+    return tuple(shape)
+
+  @staticmethod
+  def get_where_values(where_row_list):
+    # the values mk_where_clause binds for where_row_list
+    if not where_row_list: return []
+
+    value_list = []
+    for col in where_row_list:
+      if DbAccessor.is_or_group(col):
+        for sub_where_row_list in col[1]:
+          value_list.extend(DbAccessor.get_where_values(sub_where_row_list))
+      elif len(col) != 3:
+        continue
+      elif isinstance(col[1], str) and col[1].upper() in ('IN', 'NOT IN', 'BETWEEN', 'NOT BETWEEN'):
+        # checked here as well as in mk_where_terms, because a statement
+        # cache hit skips mk_where_terms
+        DbAccessor.check_where_values(col[1].upper(), col[2])
+        value_list.extend(col[2])
+      else:
+        value_list.append(col[2])
+    return value_list
+
+  @staticmethod
+  def check_where_values(op, values):
+    # an IN list must be a list of values, and a BETWEEN range a pair
+    if op in ('IN', 'NOT IN'):
+      if isinstance(values, (str, bytes)):
+        raise DbAccessorError('%s needs a list of values' % op)
+
+    elif len(values) != 2 or isinstance(values, (str, bytes)):
+      raise DbAccessorError('%s needs a (low, high) pair' % op)
+
+  @staticmethod
+  def split_where_in(where_row_list, max_values):
+    '''
+    Returns a list of where_row_lists that together select the same rows
+    as where_row_list, each binding at most max_values values. When
+    where_row_list binds too many, its largest top level IN list is
+    split into chunks; otherwise the list is [where_row_list].
+    '''
+    value_count = len(DbAccessor.get_where_values(where_row_list))
+    if value_count <= max_values: return [where_row_list]
+
+    in_index = None
+    for i, col in enumerate(where_row_list):
+      if len(col) == 3 and isinstance(col[1], str) and col[1].upper() == 'IN':
+        if in_index is None or len(col[2]) > len(where_row_list[in_index][2]):
+          in_index = i
+
+    if in_index is None:
+      raise DbAccessorError('where_row_list binds more than %d values' % max_values)
+
+    col = where_row_list[in_index]
+    in_values = list(collections.OrderedDict.fromkeys(col[2]))
+    room = max_values - (value_count - len(col[2]))
+    if room < 1:
+      raise DbAccessorError('where_row_list binds more than %d values' % max_values)
+
+    where_chunks = []
+    for start in range(0, len(in_values), room):
+      where_chunk = list(where_row_list)
+      where_chunk[in_index] = (col[0], col[1], in_values[start:start + room])
+      where_chunks.append(where_chunk)
+    return where_chunks
+
+  @staticmethod
+  def sqlite_sort_key(value):
+    # orders python values the way sqlite orders them:
+    # NULL, then numbers, then text, then blobs
+    if value is None: return (0, 0)
+    if isinstance(value, (int, float)): return (1, value)
+    if isinstance(value, str): return (2, value)
+    return (3, bytes(value))
+
+  @staticmethod
+  def sort_rows(rows, sort_cols, columns=None):
+    # sorts a list of rows in place, like ORDER BY sort_cols. Rows are
+    # indexed by column name, or by position in columns when given.
+    for col_name, sort_type in reversed(sort_cols):
+      i = col_name if columns is None else columns.index(col_name)
+      rows.sort(key=lambda row: DbAccessor.sqlite_sort_key(row[i]),
+        reverse=sort_type.upper() == 'DESC')
+
+  @staticmethod
+  def get_sort_shape(sort_cols):
+    if not sort_cols: return ()
+    return tuple(tuple(col) for col in sort_cols)
+
+  def get_stmt_cache_stats(self):
+    '''
+    Returns a dict with the statement cache's hits, misses, evictions,
+    size and maxsize, or None if stmt_cache_size is 0.
+    '''
+    if self.stmt_cache is None: return None
+    return self.stmt_cache.get_stats()
+
+  def cached_mkselect(self, table, columns=None, where_row_list=None, sort_cols=None,
+      limit=None, offset=None, after=None):
+    if self.stmt_cache is None and not self.validate:
+      return DbAccessor.mkselect(table, columns, where_row_list, sort_cols, limit, offset, after)
+
+    key = ('select', table, tuple(columns or ()),
+      DbAccessor.get_where_shape(where_row_list), DbAccessor.get_sort_shape(sort_cols),
+      limit is not None or offset is not None, offset is not None, after is not None)
+
+    if self.validate: self.check_query(key, table, columns, where_row_list, sort_cols)
+    if self.stmt_cache is None:
+      return DbAccessor.mkselect(table, columns, where_row_list, sort_cols, limit, offset, after)
+
+    stmt = self.stmt_cache.get(key)
+    if stmt is None:
+      (stmt, value_list) = DbAccessor.mkselect(table, columns, where_row_list, sort_cols, limit, offset, after)
+      self.stmt_cache.put(key, stmt)
+      return stmt, value_list
+
+    value_list = DbAccessor.get_where_values(where_row_list)
+    if after is not None:
+      value_list.extend(DbAccessor.get_seek_values(sort_cols, after))
+    if limit is not None or offset is not None:
+      value_list.append(-1 if limit is None else DbAccessor.check_count('limit', limit))
+    if offset is not None:
+      value_list.append(DbAccessor.check_count('offset', offset))
+
+    return stmt, value_list
+
+  def cached_mkupdate(self, table, set_row, where_row_list):
+    if self.stmt_cache is None and not self.validate:
+      return DbAccessor.mkupdate(table, set_row, where_row_list)
+
+    (set_key_list, value_list) = DbAccessor.get_dict_kv_lists(set_row)
+    key = ('update', table, tuple(set_key_list), DbAccessor.get_where_shape(where_row_list))
+
+    if self.validate: self.check_query(key, table, set_key_list, where_row_list)
+    if self.stmt_cache is None:
+      return DbAccessor.mkupdate(table, set_row, where_row_list)
+
+    stmt = self.stmt_cache.get(key)
+    if stmt is None:
+      (stmt, value_list) = DbAccessor.mkupdate(table, set_row, where_row_list)
+      self.stmt_cache.put(key, stmt)
+      return stmt, value_list
+
+    value_list.extend(DbAccessor.get_where_values(where_row_list))
+    return stmt, value_list
+
+  def cached_mkdelete(self, table, where_row_list):
+    if self.stmt_cache is None and not self.validate:
+      return DbAccessor.mkdelete(table, where_row_list)
+
+    key = ('delete', table, DbAccessor.get_where_shape(where_row_list))
+
+    if self.validate: self.check_query(key, table, None, where_row_list)
+    if self.stmt_cache is None:
+      return DbAccessor.mkdelete(table, where_row_list)
+
+    stmt = self.stmt_cache.get(key)
+    if stmt is None:
+      (stmt, value_list) = DbAccessor.mkdelete(table, where_row_list)
+      self.stmt_cache.put(key, stmt)
+      return stmt, value_list
+
+    return stmt, DbAccessor.get_where_values(where_row_list)
+
+  def cached_mkaggregate(self, table, group_by=None, aggs=None, where_row_list=None, having=None, sort_cols=None):
+    if self.stmt_cache is None and not self.validate:
+      return DbAccessor.mkaggregate(table, group_by, aggs, where_row_list, having, sort_cols)
+
+    agg_list = DbAccessor.get_agg_list(aggs or {'*': 'count'})
+    key = ('aggregate', table, tuple(group_by or ()), tuple(agg_list),
+      DbAccessor.get_where_shape(where_row_list), DbAccessor.get_where_shape(having),
+      DbAccessor.get_sort_shape(sort_cols))
+
+    if self.validate:
+      agg_cols = [col_name for col_name, _, _ in agg_list if col_name != '*']
+      self.check_query(key, table, list(group_by or ()) + agg_cols, where_row_list)
+    if self.stmt_cache is None:
+      return DbAccessor.mkaggregate(table, group_by, aggs, where_row_list, having, sort_cols)
+
+    entry = self.stmt_cache.get(key)
+    if entry is None:
+      (stmt, value_list, columns) = DbAccessor.mkaggregate(table, group_by, aggs, where_row_list, having, sort_cols)
+      self.stmt_cache.put(key, (stmt, columns))
+      return stmt, value_list, columns
+
+    (stmt, columns) = entry
+    value_list = DbAccessor.get_where_values(where_row_list) + DbAccessor.get_where_values(having)
+    return stmt, value_list, columns
+
+  def cached_mkinsert(self, table, values, on_conflict=None, conflict_cols=None, update_cols=None):
+    if self.stmt_cache is None and not self.validate:
+      return DbAccessor.mkinsert(table, values, on_conflict, conflict_cols, update_cols)
+
+    key = ('insert', table, tuple(values[0].keys()), on_conflict,
+      tuple(conflict_cols or ()), tuple(update_cols or ()))
+
+    if self.validate: self.check_query(key, table, key[2] + key[4] + key[5])
+    if self.stmt_cache is None:
+      return DbAccessor.mkinsert(table, values, on_conflict, conflict_cols, update_cols)
+
+    stmt = self.stmt_cache.get(key)
+    if stmt is None:
+      stmt = DbAccessor.mkinsert(table, values, on_conflict, conflict_cols, update_cols)
+      self.stmt_cache.put(key, stmt)
+
+    return stmt
+
+
+  #---------  Data Access Methods (CRUD) -------------------
+
+  @staticmethod
+  def get_dict_kv_lists(dict_table):
+    klst, vlst = [],[]
+    for k,v in dict_table.items():
+      klst.append(k)
+      vlst.append(v)
+    return(klst, vlst)    
+
+  @staticmethod
+  def mkupdate(table, set_row, where_row_list):
+
+    (set_key_list, value_list) = DbAccessor.get_dict_kv_lists(set_row)
+
+
+    stmt = 'UPDATE ' + table + " \n"
+    stmt += "SET "
+    stmt += ', '.join([k + ' = ' + '?'  for k in set_key_list])
+
+    (where_clause, where_value_list) = DbAccessor.mk_where_clause(where_row_list)
+    stmt += where_clause
+    stmt += ";"
+
+    value_list.extend(where_value_list)
+
+    return(stmt, value_list)
 
 
   def update(self, table, set_row, where_row_list):
-    (stmt, value_list) = DbAccessor.mkupdate(table, set_row, where_row_list)
+    self.check_writable()
+    where_chunks = DbAccessor.split_where_in(where_row_list, self.max_variables - len(set_row))
+    if len(where_chunks) > 1:
+      with self.transaction():
+        for where_chunk in where_chunks: self.update(table, set_row, where_chunk)
+      return
+
+    (stmt, value_list) = self.cached_mkupdate(table, set_row, where_row_list)
     self.execute( stmt, value_list )
 
 
   @staticmethod 
   def mk_where_clause(where_row_list):
-    valid_comp_op = ('=', '>', '<', '>=', '<=', '!=', '<>')
+    '''
+    Returns (where_clause, value_list) for where_row_list, a list of
+    conditions that are ANDed together. Each condition is one of:
+
+      ('beta', '>', 1.0)               -- =, >, <, >=, <=, !=, <>
+      ('ticker', 'LIKE', 'i%')         -- LIKE, NOT LIKE, GLOB, NOT GLOB
+      ('ticker', 'IN', ['ibm', 'xom']) -- IN, NOT IN
+      ('price', 'BETWEEN', (10, 50))   -- BETWEEN, NOT BETWEEN
+      ('industry', 'IS NULL')          -- IS NULL, IS NOT NULL
+      ('OR', [where_row_list, ...])    -- true when any one of the
+                                          nested where_row_lists is true
+    '''
     #where_row_list structure
     #[('industry', '=', 'technology'), ('beta', '>', 1.0), ...]
 
@@ -343,20 +1891,68 @@ class DbAccessor(object):
       value_list = []
 
     else:
-        for col in where_row_list:
-          if col[1] not in valid_comp_op:
-            raise DbAccessorError('bad compariso operator: %s' % col[1])
-
-          if len(col) != 3:
-            raise DbAccessorError('column tuple length not equal 3')
-
         where_clause = "\nWHERE "
-        where_clause += "\n  AND ".join(["%s %s ?" % (col[0], col[1])  for col in where_row_list])
+        where_clause += "\n  AND ".join(DbAccessor.mk_where_terms(where_row_list))
 
-        value_list = [col[2] for col in where_row_list]
+        value_list = DbAccessor.get_where_values(where_row_list)
 
     return where_clause, value_list
 
+  @staticmethod
+  def is_or_group(col):
+    return (len(col) == 2 and isinstance(col[0], str) and col[0].upper() == 'OR'
+      and isinstance(col[1], (list, tuple)))
+
+  @staticmethod
+  def mk_where_terms(where_row_list):
+    # returns the SQL for each condition in where_row_list
+    valid_comp_op = ('=', '>', '<', '>=', '<=', '!=', '<>', 'LIKE', 'NOT LIKE', 'GLOB', 'NOT GLOB')
+    valid_list_op = ('IN', 'NOT IN')
+    valid_range_op = ('BETWEEN', 'NOT BETWEEN')
+    valid_null_op = ('IS NULL', 'IS NOT NULL')
+
+    terms = []
+    for col in where_row_list:
+      if DbAccessor.is_or_group(col):
+        if not col[1]:
+          raise DbAccessorError('empty OR group')
+
+        or_list = []
+        for sub_where_row_list in col[1]:
+          if not sub_where_row_list:
+            raise DbAccessorError('empty where_row_list in OR group')
+          or_list.append('(' + ' AND '.join(DbAccessor.mk_where_terms(sub_where_row_list)) + ')')
+
+        terms.append('(' + ' OR '.join(or_list) + ')')
+        continue
+
+      op = col[1].upper() if isinstance(col[1], str) else col[1]
+
+      if op in valid_null_op:
+        if len(col) != 2:
+          raise DbAccessorError('column tuple length not equal 2')
+        terms.append("%s %s" % (col[0], op))
+        continue
+
+      if op not in valid_comp_op + valid_list_op + valid_range_op:
+        raise DbAccessorError('bad compariso operator: %s' % col[1])
+
+      if len(col) != 3:
+        raise DbAccessorError('column tuple length not equal 3')
+
+      if op in valid_list_op:
+        DbAccessor.check_where_values(op, col[2])
+        terms.append("%s %s (%s)" % (col[0], op, ', '.join(['?'] * len(col[2]))))
+
+      elif op in valid_range_op:
+        DbAccessor.check_where_values(op, col[2])
+        terms.append("%s %s ? AND ?" % (col[0], op))
+
+      else:
+        terms.append("%s %s ?" % (col[0], op))
+
+    return terms
+
   @staticmethod
   def mkdelete(table, where_row_list):
     stmt = "DELETE FROM " + table
@@ -369,13 +1965,144 @@ class DbAccessor(object):
 
 
   def delete(self, table, where_row_list=None):
-    (stmt, value_list) = DbAccessor.mkdelete(table, where_row_list)
+    self.check_writable()
+    where_chunks = DbAccessor.split_where_in(where_row_list, self.max_variables)
+    if len(where_chunks) > 1:
+      with self.transaction():
+        for where_chunk in where_chunks: self.delete(table, where_chunk)
+      return
+
+    (stmt, value_list) = self.cached_mkdelete(table, where_row_list)
     self.execute(stmt,value_list)
 
 
+  def update_many(self, table, rows, key_cols, chunk_size=10000):
+    '''
+    Updates many rows, each with its own values, in one transaction.
+
+    Arguments:
+    table           -- name of the table to be updated
+    rows            -- list (or any iterable) of dicts. Every dict has
+                       the same keys: the key_cols, which pick the row
+                       to update, and the columns to set.
+    key_cols        -- list of column names used in the WHERE clause,
+                       e.g. ['ticker']
+
+    e.g. db.update_many('stocks', [{'ticker': 'ibm', 'price': 57},
+                                   {'ticker': 'dal', 'price': 35}], ['ticker'])
+
+    One UPDATE statement is built with mkupdate and run with
+    executemany, chunk_size rows at a time.
+
+    Returns: number of rows updated.
+    '''
+    self.check_writable()
+    if not key_cols:
+      raise DbAccessorError('update_many needs key_cols')
+
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None: return 0
+
+    set_cols = [col for col in first.keys() if col not in key_cols]
+    if not set_cols:
+      raise DbAccessorError('update_many rows have no columns to set')
+
+    set_row = dict((col, None) for col in set_cols)
+    where_row_list = [(col, '=', None) for col in key_cols]
+    (stmt, _) = self.cached_mkupdate(table, set_row, where_row_list)
+
+    getter = operator.itemgetter(*(set_cols + list(key_cols)))
+    params = (getter(row) for row in itertools.chain([first], rows))
+
+    count = 0
+    with self.transaction():
+      while True:
+        chunk = list(itertools.islice(params, chunk_size))
+        if not chunk: break
+        count += self.executemany(stmt, chunk).rowcount
+
+    return count
+
+
+  def delete_many(self, table, key_col, values, chunk_size=10000):
+    '''
+    Deletes every row whose key_col equals one of values, in one
+    transaction.
+
+    e.g. db.delete_many('stocks', 'ticker', ['ibm', 'dal', 'xom'])
+
+    One DELETE statement is built with mkdelete and run with
+    executemany, chunk_size values at a time.
+
+    Returns: number of rows deleted.
+    '''
+    self.check_writable()
+    (stmt, _) = self.cached_mkdelete(table, [(key_col, '=', None)])
+    params = ((value,) for value in values)
+
+    count = 0
+    with self.transaction():
+      while True:
+        chunk = list(itertools.islice(params, chunk_size))
+        if not chunk: break
+        count += self.executemany(stmt, chunk).rowcount
+
+    return count
+
+
+
+  @staticmethod
+  def mk_seek_clause(sort_cols, after):
+    '''
+    Returns (clause, value_list) selecting the rows that come after the
+    row whose sort_cols values are after, in sort_cols order. Used for
+    keyset pagination.
+
+    When all sort_cols have the same direction this is a row value
+    comparison, e.g. (industry, ticker) > (?, ?), which sqlite can
+    answer with an index seek. Mixed directions are spelled out:
+    (industry < ?) OR (industry = ? AND ticker > ?)
+    '''
+    if not sort_cols or len(after) != len(sort_cols):
+      raise DbAccessorError('seek values do not match sort columns')
+
+    directions = set(sort_type.upper() for _, sort_type in sort_cols)
+    if not directions <= set(('ASC', 'DESC')):
+      raise DbAccessorError('bad sort type in %s' % (sort_cols,))
+
+    col_names = [col_name for col_name, _ in sort_cols]
+
+    if len(directions) == 1:
+      op = '>' if 'ASC' in directions else '<'
+      if len(col_names) == 1:
+        clause = '%s %s ?' % (col_names[0], op)
+      else:
+        clause = '(%s) %s (%s)' % (', '.join(col_names), op, ', '.join(['?'] * len(col_names)))
+      return clause, list(after)
+
+    or_list = []
+    for i, (col_name, sort_type) in enumerate(sort_cols):
+      op = '>' if sort_type.upper() == 'ASC' else '<'
+      and_list = ['%s = ?' % name for name in col_names[:i]]
+      and_list.append('%s %s ?' % (col_name, op))
+      or_list.append('(' + ' AND '.join(and_list) + ')')
+
+    return '(' + ' OR '.join(or_list) + ')', DbAccessor.get_seek_values(sort_cols, after)
+
+  @staticmethod
+  def get_seek_values(sort_cols, after):
+    # the values mk_seek_clause binds for after
+    if len(set(sort_type.upper() for _, sort_type in sort_cols)) == 1:
+      return list(after)
+
+    value_list = []
+    for i in range(len(after)):
+      value_list.extend(after[:i + 1])
+    return value_list
 
   @staticmethod
-  def mkselect(table, columns=None, where_row_list=None, sort_cols=None):
+  def mkselect(table, columns=None, where_row_list=None, sort_cols=None, limit=None, offset=None, after=None):
 
     vaild_sort_op = ('ASC', 'DESC')
 
@@ -391,6 +2118,13 @@ class DbAccessor(object):
     (where_clause, value_list) = DbAccessor.mk_where_clause(where_row_list)
     stmt += where_clause
 
+    # keyset pagination: only rows after the given sort key values
+    if after is not None:
+      (seek_clause, seek_value_list) = DbAccessor.mk_seek_clause(sort_cols, after)
+      stmt += "\n  AND " if where_clause else "\nWHERE "
+      stmt += seek_clause
+      value_list.extend(seek_value_list)
+
 
     # order clause
     # sort_cols = [('name_last', 'ASC'), ('age', 'DESC')]
@@ -405,14 +2139,30 @@ class DbAccessor(object):
       stmt += "\nORDER BY "
       stmt += ', '.join(sort_list)
 
+    # limit and offset are bound, so every page shares one statement
+    if limit is not None or offset is not None:
+      stmt += "\nLIMIT ?"
+      value_list.append(-1 if limit is None else DbAccessor.check_count('limit', limit))
+
+    if offset is not None:
+      stmt += " OFFSET ?"
+      value_list.append(DbAccessor.check_count('offset', offset))
+
     stmt += ';'
 
     return stmt, value_list
 
+  @staticmethod
+  def check_count(name, count):
+    if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+      raise DbAccessorError('bad %s: %s' % (name, count))
+    return count
+
 
 
 
-  def read(self, table, columns=None, where_row_list=None, sort_cols=None):
+  def read(self, table, columns=None, where_row_list=None, sort_cols=None, limit=None, offset=None,
+      row_format=None):
     '''
     Executes a SELECT statement against table.
 
@@ -431,11 +2181,33 @@ class DbAccessor(object):
                             They will be executed with:
                             cur.execute(stmt, value_list)
 
+                            IN, BETWEEN, LIKE, GLOB, IS NULL and OR
+                            groups are also accepted (see mk_where_clause).
+                            An IN list longer than sqlite allows in one
+                            statement is split over several SELECTs.
+
     sort_cols (optional)  -- list of (column, order) pairs
                           used to specify order of the
                           rows returned. Needs to be of
                           the form ('<column>', 'ASC'|'DESC')
 
+    limit (optional)      -- maximum number of rows to return
+
+    offset (optional)     -- number of rows to skip first. Note
+                          that sqlite still steps over the skipped
+                          rows; for deep pages use read_page.
+
+    row_format (optional) -- how each row is returned:
+                          'dict'       -- a new dict per row (the default,
+                                          unless the accessor was opened
+                                          with another row_format)
+                          'tuple'      -- plain tuples, in columns order
+                          'namedtuple' -- tuples whose fields can also
+                                          be read by name (row.ticker);
+                                          one class per column list
+                          'row'        -- sqlite3.Row, readable by index
+                                          or name (row['ticker'])
+
     Returns: rows returned from the SELECT statement.
     '''
 
@@ -450,34 +2222,657 @@ class DbAccessor(object):
     # See class: DbSchemaValidator
 
     if not columns: columns = self.get_field_names(table)
+    if row_format is None: row_format = self.row_format
+
+    where_chunks = DbAccessor.split_where_in(where_row_list, self.max_variables - 2)
+    if len(where_chunks) > 1:
+      return self.read_where_chunks(table, columns, where_chunks, sort_cols, limit, offset, row_format)
 
-    (stmt, value_list) = DbAccessor.mkselect(table, columns, where_row_list, sort_cols)
+    (stmt, value_list) = self.cached_mkselect(table, columns, where_row_list, sort_cols, limit, offset)
 
-    tuple_row_list = self.execute(stmt, value_list)
+    if self.result_cache is not None:
+      return self.read_cached(table, columns, stmt, value_list, row_format)
 
-    result_list = [dict(zip(columns, trow)) for trow in tuple_row_list]
+    with self.borrow():
+      cur = self.execute(stmt, value_list)
+
+      result_list = self.record_fetch(stmt, self.fetch_rows(cur, columns, row_format))
 
 
     return(result_list)
 
 
+  @staticmethod
+  def check_row_format(row_format):
+    valid_row_format = ('dict', 'tuple', 'namedtuple', 'row')
+    if row_format not in valid_row_format:
+      raise DbAccessorError('bad row_format: %s' % row_format)
+
+  @staticmethod
+  @functools.lru_cache(maxsize=256)
+  def get_row_class(columns):
+    # one namedtuple class per column tuple; names that are not valid
+    # identifiers become _0, _1, ...
+    return collections.namedtuple('Row', columns, rename=True)
+
+  @staticmethod
+  def convert_rows(columns, tuple_row_list, row_format):
+    if row_format == 'dict':
+      return [dict(zip(columns, trow)) for trow in tuple_row_list]
+
+    if row_format == 'namedtuple':
+      make_row = DbAccessor.get_row_class(tuple(columns))._make
+      return [make_row(trow) for trow in tuple_row_list]
+
+    return list(tuple_row_list)
+
+  def fetch_rows(self, cur, columns, row_format, size=None):
+    # fetches all rows (or the next size rows) from cur in row_format
+    DbAccessor.check_row_format(row_format)
+    if row_format == 'row': cur.row_factory = sqlite3.Row
+
+    tuple_row_list = cur.fetchall() if size is None else cur.fetchmany(size)
+    return DbAccessor.convert_rows(columns, tuple_row_list, row_format)
+
+
+  def read_where_chunks(self, table, columns, where_chunks, sort_cols=None, limit=None, offset=None,
+      row_format='dict'):
+    # reads each where_row_list in where_chunks (see split_where_in) and
+    # merges the rows, then applies sort_cols, offset and limit. Sort
+    # columns that are not in columns are read after them, as in
+    # read_page, and dropped again once the rows are sorted.
+    select_columns = list(columns)
+    for col_name, _ in sort_cols or []:
+      if col_name not in select_columns: select_columns.append(col_name)
+
+    chunk_limit = None if limit is None else limit + (offset or 0)
+    chunk_format = 'row' if row_format == 'row' else 'tuple'
+
+    tuple_row_list = []
+    for where_chunk in where_chunks:
+      tuple_row_list.extend(self.read(table, select_columns, where_chunk, sort_cols, chunk_limit, None,
+        chunk_format))
+
+    if sort_cols: DbAccessor.sort_rows(tuple_row_list, sort_cols, select_columns)
+
+    start = offset or 0
+    end = None if limit is None else start + limit
+    tuple_row_list = tuple_row_list[start:end]
+
+    # an sqlite3.Row keeps the extra sort columns
+    if row_format == 'row': return tuple_row_list
+
+    ncols = len(columns)
+    if ncols < len(select_columns):
+      tuple_row_list = [trow[:ncols] for trow in tuple_row_list]
+    return DbAccessor.convert_rows(columns, tuple_row_list, row_format)
+
+
+  def read_iter(self, table, columns=None, where_row_list=None, sort_cols=None, batch_size=1000,
+      limit=None, offset=None, row_format=None):
+    '''
+    Executes a SELECT statement against table and yields the rows
+    one at a time instead of building the whole result list.
+
+    Arguments are the same as for read, plus:
+
+    batch_size (optional) -- number of rows fetched from the cursor
+                             with each fetchmany call
+
+    Returns: a generator of rows (dicts, or see row_format in read).
+    Rows are pulled from sqlite in batch_size chunks, so memory use stays
+    flat no matter how many rows the SELECT statement returns.
+    '''
+
+    if batch_size < 1:
+      raise DbAccessorError('bad batch_size: %s' % batch_size)
+
+    if not columns: columns = self.get_field_names(table)
+    if row_format is None: row_format = self.row_format
+
+    where_chunks = DbAccessor.split_where_in(where_row_list, self.max_variables - 2)
+    if len(where_chunks) > 1:
+      if sort_cols or limit is not None or offset is not None:
+        rows = self.read_where_chunks(table, columns, where_chunks, sort_cols, limit, offset, row_format)
+      else:
+        rows = itertools.chain.from_iterable(
+          self.read_iter(table, columns, where_chunk, batch_size=batch_size, row_format=row_format)
+          for where_chunk in where_chunks)
+
+      for row in rows: yield row
+      return
+
+    (stmt, value_list) = self.cached_mkselect(table, columns, where_row_list, sort_cols, limit, offset)
+
+    # in pooled mode the reader connection stays checked out until
+    # the generator is exhausted or closed
+    with self.borrow():
+      cur = self.execute(stmt, value_list)
+
+      try:
+        while True:
+          row_list = self.record_fetch(stmt, self.fetch_rows(cur, columns, row_format, batch_size))
+          if not row_list: break
+
+          for row in row_list:
+            yield row
+
+      finally:
+        cur.close()
+
+
+  def read_columns(self, table, columns=None, where_row_list=None, sort_cols=None, limit=None, offset=None,
+      batch_size=10000, use_numpy=None):
+    '''
+    Executes a SELECT statement against table and returns the result
+    column by column, without building a dict (or tuple) per row.
+
+    Arguments are the same as for read, plus:
+
+    batch_size (optional) -- number of rows fetched from the cursor
+                             with each fetchmany call
+
+    use_numpy (optional)  -- True for NumPy arrays, False for
+                             array.array; the default is NumPy
+                             when it is installed
+
+    Returns: {<column>: <values>, ...}. Integer columns become int64
+    arrays and real/numeric columns float64 arrays (typecodes 'q' and
+    'd'), using the declared types from get_field_name_type_list. NULLs
+    in float columns are read as NaN; an integer column holding NULLs or
+    floats is widened to float64. Text, blob and untyped columns, and
+    numeric columns holding text, are returned as lists (object arrays
+    with NumPy).
+    '''
+
+    if batch_size < 1:
+      raise DbAccessorError('bad batch_size: %s' % batch_size)
+
+    if use_numpy is None: use_numpy = numpy is not None
+    if use_numpy and numpy is None:
+      raise DbAccessorError('use_numpy: numpy is not installed')
+
+    if not columns: columns = self.get_field_names(table)
+
+    type_dict = dict(self.get_field_name_type_list(table))
+    type_dict.setdefault('rowid', 'integer')
+    column_list = [DbAccessor.new_column(type_dict.get(col_name)) for col_name in columns]
+
+    for tuple_row_list in self.read_batches(table, columns, where_row_list, sort_cols, limit, offset, batch_size):
+      # transpose the batch: one tuple of values per column
+      for i, values in enumerate(zip(*tuple_row_list)):
+        column_list[i] = DbAccessor.extend_column(column_list[i], values)
+
+    if use_numpy:
+      column_list = [DbAccessor.column_to_numpy(values) for values in column_list]
+
+    return dict(zip(columns, column_list))
+
+  def read_batches(self, table, columns, where_row_list, sort_cols, limit, offset, batch_size):
+    # yields lists of up to batch_size tuple rows
+    where_chunks = DbAccessor.split_where_in(where_row_list, self.max_variables - 2)
+    if len(where_chunks) > 1:
+      rows = iter(self.read_iter(table, columns, where_row_list, sort_cols, batch_size, limit, offset,
+        row_format='tuple'))
+
+      while True:
+        tuple_row_list = list(itertools.islice(rows, batch_size))
+        if not tuple_row_list: break
+        yield tuple_row_list
+
+      return
+
+    (stmt, value_list) = self.cached_mkselect(table, columns, where_row_list, sort_cols, limit, offset)
+
+    with self.borrow():
+      cur = self.execute(stmt, value_list)
+
+      try:
+        while True:
+          tuple_row_list = self.record_fetch(stmt, cur.fetchmany(batch_size))
+          if not tuple_row_list: break
+          yield tuple_row_list
+
+      finally:
+        cur.close()
+
+  def parallel_read(self, table, columns=None, where_row_list=None, sort_cols=None, workers=None,
+      func=None, reduce=None, key_col='rowid', partitions=None, row_format=None, mode='ro'):
+    '''
+    Reads table with a pool of worker processes, each scanning one range
+    of key_col with its own read-only DbAccessor.
+
+    Arguments are the same as for read, plus:
+
+    workers (optional)    -- number of processes (default os.cpu_count())
+    func (optional)       -- func(rows) is called in the worker on each
+                          range's rows; its results are returned
+                          instead of the rows
+    reduce (optional)     -- reduce(a, b) folds the func results into
+                          one value, in range order
+    key_col (optional)    -- integer (or real) column the ranges are cut
+                          on; rowid by default, otherwise it should be
+                          indexed. Rows whose key_col is NULL are read
+                          as a range of their own
+    partitions (optional) -- number of ranges (default 4 per worker), so
+                          a slow range does not hold up the others
+    mode (optional)       -- 'ro' or 'immutable', as for DbAccessor
+
+    func and reduce must be picklable, i.e. module level functions.
+    Workers only see committed data. Rows returned without func are
+    pickled back to this process, which can cost more than the scan;
+    the speedup comes from func doing the work in the workers.
+
+    Returns: without func, the rows of all ranges (in sort_cols order when
+    given, otherwise in key_col order); with func, the list of func
+    results, or the reduced value when reduce is given.
+    '''
+    if self.dbpath == ':memory:':
+      raise DbAccessorError('parallel_read needs a database file, not :memory:')
+
+    if not columns: columns = self.get_field_names(table)
+    if row_format is None: row_format = self.row_format
+    DbAccessor.check_row_format(row_format)
+
+    # sqlite3.Row and the namedtuple classes cannot be sent between processes
+    if func is None and row_format == 'row':
+      raise DbAccessorError("parallel_read without func cannot return row_format='row'")
+    worker_row_format = 'tuple' if func is None and row_format == 'namedtuple' else row_format
+
+    if func is None and sort_cols:
+      for col_name, _ in sort_cols:
+        if col_name not in columns:
+          raise DbAccessorError('sort column %s must be one of columns' % col_name)
+
+    if not workers: workers = os.cpu_count() or 1
+    if not partitions: partitions = workers * 4
+
+    (low, high) = self.aggregate(table, aggs={key_col: ['min', 'max']}, row_format='tuple')[0]
+    where_chunks = [list(where_row_list or []) + key_range
+      for key_range in DbAccessor.get_key_ranges(key_col, low, high, partitions)]
+
+    db_kwargs = {'mode': mode, 'profile': self.profile, 'pragmas': self.pragmas,
+      'stmt_cache_size': self.stmt_cache_size, 'new_db_ok': False}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=parallel_read_init,
+        initargs=(self.dbpath, db_kwargs)) as executor:
+      futures = [executor.submit(parallel_read_worker, table, columns, where_chunk, sort_cols,
+        worker_row_format, func) for where_chunk in where_chunks]
+      results = [future.result() for future in futures]
+
+    if func is not None:
+      if reduce is None: return results
+      return functools.reduce(reduce, results)
+
+    rows = list(itertools.chain.from_iterable(results))
+
+    # each range is already sorted, and sort() finds the sorted runs
+    if sort_cols:
+      DbAccessor.sort_rows(rows, sort_cols, None if row_format == 'dict' else list(columns))
+
+    if row_format == 'namedtuple': rows = DbAccessor.convert_rows(columns, rows, 'namedtuple')
+    return rows
+
+  @staticmethod
+  def get_key_ranges(key_col, low, high, partitions):
+    # where_row_list conditions splitting [low, high] into about
+    # partitions ranges; a single unbounded range for an empty table.
+    # A column other than rowid can also hold NULLs, which sort first.
+    if low is None: return [[]]
+
+    for value in (low, high):
+      if not isinstance(value, (int, float)):
+        raise DbAccessorError('parallel_read key column %s must hold numbers, not %r' % (key_col, value))
+
+    key_ranges = []
+    if key_col.lower() not in ('rowid', 'oid', '_rowid_'):
+      key_ranges.append([(key_col, 'IS NULL')])
+
+    if isinstance(low, int) and isinstance(high, int):
+      bounds = sorted(set(low + (high - low + 1) * i // partitions for i in range(partitions)))
+    else:
+      bounds = [low + (high - low) * i / float(partitions) for i in range(partitions)]
+
+    for i, start in enumerate(bounds):
+      if i + 1 < len(bounds):
+        key_ranges.append([(key_col, '>=', start), (key_col, '<', bounds[i + 1])])
+      else:
+        key_ranges.append([(key_col, '>=', start), (key_col, '<=', high)])
+    return key_ranges
 
   @staticmethod
-  def mkinsert(table, values):
+  def new_column(field_type):
+    # picks the array typecode for a declared type, following sqlite's
+    # column affinity rules; None means a plain list
+    field_type = (field_type or '').upper()
+
+    if 'INT' in field_type: return array.array('q')
+    if any(s in field_type for s in ('CHAR', 'CLOB', 'TEXT', 'BLOB')) or not field_type: return []
+
+    return array.array('d')
+
+  @staticmethod
+  def extend_column(column, values):
+    # appends values to column, widening int64 -> float64 -> list when
+    # a value does not fit; returns the (possibly new) column
+    if isinstance(column, array.array) and column.typecode == 'q':
+      try:
+        column.extend(array.array('q', values))
+        return column
+      except (TypeError, OverflowError):
+        column = array.array('d', column)
+
+    if isinstance(column, array.array):
+      try:
+        column.extend(array.array('d', [float('nan') if v is None else v for v in values]))
+        return column
+      except (TypeError, OverflowError):
+        column = list(column)
+
+    column.extend(values)
+    return column
+
+  @staticmethod
+  def column_to_numpy(column):
+    if isinstance(column, list): return numpy.array(column, dtype=object)
+
+    # int64 / float64 view over the array's buffer, without a copy
+    return numpy.frombuffer(column, dtype=column.typecode) if len(column) else numpy.empty(0, column.typecode)
+
+
+  @staticmethod
+  def encode_page_cursor(key_values):
+    return base64.urlsafe_b64encode(json.dumps(key_values).encode('utf-8')).decode('ascii')
+
+  @staticmethod
+  def decode_page_cursor(cursor):
+    try:
+      key_values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, AttributeError) as error:
+      raise DbAccessorError('bad page cursor: %s' % error)
+
+    if not isinstance(key_values, list):
+      raise DbAccessorError('bad page cursor: %s' % cursor)
+    return key_values
+
+
+  def read_page(self, table, columns=None, where_row_list=None, sort_cols=None, page_size=100, cursor=None,
+      row_format=None):
+    '''
+    Reads one page of rows using keyset ("seek") pagination.
+
+    Arguments are the same as for read, plus:
+
+    page_size (optional) -- maximum number of rows on the page (at least 1)
+    cursor (optional)    -- the cursor returned with the previous page;
+                            None for the first page
+
+    Instead of an OFFSET, each page starts with a WHERE condition on the
+    sort_cols values of the previous page's last row, so with an index
+    on the sort columns page N costs the same as page 1. The sort_cols
+    must identify a row uniquely (end them with a unique column such as
+    id) and should not contain NULLs. Without sort_cols rows are paged
+    in rowid order.
+
+    Returns: (rows, next_cursor). next_cursor is a string to pass back
+    for the next page, or None after the last page. With row_format='row'
+    each sqlite3.Row also holds any sort columns not in columns.
+
+    rows, cursor = db.read_page('stocks', sort_cols=[('ticker', 'ASC')], page_size=50)
+    while cursor:
+      rows, cursor = db.read_page('stocks', sort_cols=[('ticker', 'ASC')], page_size=50, cursor=cursor)
+    '''
+    if not sort_cols: sort_cols = [('rowid', 'ASC')]
+    if not columns: columns = self.get_field_names(table)
+    if row_format is None: row_format = self.row_format
+    DbAccessor.check_row_format(row_format)
+
+    page_size = DbAccessor.check_count('page_size', page_size)
+    if page_size < 1:
+      raise DbAccessorError('bad page_size: %s' % page_size)
+    after = None if cursor is None else DbAccessor.decode_page_cursor(cursor)
+
+    # sort key columns that are not already read are read after the
+    # requested columns, so the next cursor can be made from the last row
+    select_columns = list(columns)
+    key_index_list = []
+    for col_name, _ in sort_cols:
+      if col_name not in select_columns: select_columns.append(col_name)
+      key_index_list.append(select_columns.index(col_name))
+
+    # a long IN list is split: every chunk returns its first page_size + 1
+    # rows after the cursor, and the merged page is the first of those
+    seek_count = 1 if after is None else len(DbAccessor.get_seek_values(sort_cols, after)) + 1
+    where_chunks = DbAccessor.split_where_in(where_row_list, self.max_variables - seek_count)
+
+    tuple_row_list = []
+    with self.borrow():
+      for where_chunk in where_chunks:
+        (stmt, value_list) = self.cached_mkselect(table, select_columns, where_chunk, sort_cols,
+          page_size + 1, None, after)
+        cur = self.execute(stmt, value_list)
+        if row_format == 'row': cur.row_factory = sqlite3.Row
+        tuple_row_list.extend(self.record_fetch(stmt, cur.fetchall()))
+
+    if len(where_chunks) > 1:
+      DbAccessor.sort_rows(tuple_row_list, sort_cols, select_columns)
+
+    next_cursor = None
+    if len(tuple_row_list) > page_size:
+      last_row = tuple_row_list[page_size - 1]
+      next_cursor = DbAccessor.encode_page_cursor([last_row[i] for i in key_index_list])
+
+    tuple_row_list = tuple_row_list[:page_size]
+    ncols = len(columns)
+    if row_format != 'row' and ncols < len(select_columns):
+      tuple_row_list = [trow[:ncols] for trow in tuple_row_list]
+
+    result_list = DbAccessor.convert_rows(columns, tuple_row_list, row_format)
+
+    return result_list, next_cursor
+
+
+  @staticmethod
+  def get_agg_list(aggs):
+    # [(column, function, result name), ...] for an aggs dict like
+    # {'price': 'avg', 'beta': ['min', 'max'], '*': 'count'}
+    valid_agg_func = ('count', 'sum', 'total', 'avg', 'min', 'max', 'group_concat')
+
+    agg_list = []
+    for col_name, funcs in aggs.items():
+      if isinstance(funcs, str): funcs = [funcs]
+      for func in funcs:
+        if func.lower() not in valid_agg_func:
+          raise DbAccessorError('bad aggregate function: %s' % func)
+        if col_name == '*' and func.lower() != 'count':
+          raise DbAccessorError('%s(*) is not allowed' % func)
+
+        name = func.lower() if col_name == '*' else '%s_%s' % (func.lower(), col_name)
+        agg_list.append((col_name, func.lower(), name))
+
+    return agg_list
+
+  @staticmethod
+  def mkaggregate(table, group_by=None, aggs=None, where_row_list=None, having=None, sort_cols=None):
+    '''
+    Returns (stmt, value_list, columns) for a GROUP BY query, where
+    columns are the names of the result columns: the group_by columns,
+    then one per aggregate (see aggregate). having and sort_cols may
+    only name those result columns.
+    '''
+    vaild_sort_op = ('ASC', 'DESC')
+
+    group_by = list(group_by or [])
+    agg_list = DbAccessor.get_agg_list(aggs or {'*': 'count'})
+
+    columns = group_by + [name for _, _, name in agg_list]
+    select_list = list(group_by)
+    for col_name, func, name in agg_list:
+      select_list.append('%s(%s) AS %s' % (func, col_name, name))
+
+    stmt = 'SELECT ' + ', '.join(select_list)
+    stmt += "\nFROM " + table
+
+    (where_clause, value_list) = DbAccessor.mk_where_clause(where_row_list)
+    stmt += where_clause
+
+    if group_by:
+      stmt += "\nGROUP BY " + ', '.join(group_by)
+
+    # HAVING and ORDER BY refer to the result columns by name
+    for col_name in DbSchemaValidator.get_where_col_names(having) + [col for col, _ in sort_cols or []]:
+      if col_name not in columns:
+        raise DbAccessorError('%s is not a result column of the aggregate' % col_name)
+
+    if having:
+      stmt += "\nHAVING " + "\n  AND ".join(DbAccessor.mk_where_terms(having))
+      value_list.extend(DbAccessor.get_where_values(having))
+
+    if sort_cols:
+      sort_list = []
+      for col_name, sort_type in sort_cols:
+        if not sort_type.upper() in vaild_sort_op:
+          raise DbAccessorError('bad sort type %s' % sort_type)
+        sort_list.append(col_name + ' ' + sort_type)
+
+      stmt += "\nORDER BY " + ', '.join(sort_list)
+
+    stmt += ';'
+
+    return stmt, value_list, columns
+
+  def aggregate(self, table, group_by=None, aggs=None, where_row_list=None, having=None, sort_cols=None,
+      row_format=None):
+    '''
+    Runs a GROUP BY query in sqlite and returns only the summary rows.
+
+    Arguments:
+    table           -- name of the table to be read
+    group_by (optional)   -- list of columns to group on; no groups
+                          gives one row for the whole table
+    aggs (optional)       -- {<column>: <function> | [<function>, ...]}
+                          with functions count, sum, total, avg, min,
+                          max and group_concat, and '*' for count(*).
+                          Defaults to {'*': 'count'}.
+    where_row_list (optional) -- rows to aggregate, as for read
+    having (optional)     -- conditions on the result columns, in the
+                          where_row_list form
+    sort_cols (optional)  -- order of the result rows, by result column
+    row_format (optional) -- as for read
+
+    Each aggregate comes back as <function>_<column> (e.g. avg_price),
+    and count(*) as count.
+
+    e.g. db.aggregate('stocks', ['industry'], {'price': ['avg', 'max'], '*': 'count'},
+           having=[('count', '>', 1)], sort_cols=[('avg_price', 'DESC')])
+         -> [{'industry': 'technology', 'avg_price': 45.0, 'max_price': 56, 'count': 2}, ...]
+    '''
+    if row_format is None: row_format = self.row_format
+
+    # groups cannot be merged across chunks, so a long IN list is not split
+    value_count = len(DbAccessor.get_where_values(where_row_list)) + len(DbAccessor.get_where_values(having))
+    if value_count > self.max_variables:
+      raise DbAccessorError('aggregate binds more than %d values' % self.max_variables)
+
+    (stmt, value_list, columns) = self.cached_mkaggregate(table, group_by, aggs, where_row_list, having, sort_cols)
+
+    with self.borrow():
+      cur = self.execute(stmt, value_list)
+      return self.record_fetch(stmt, self.fetch_rows(cur, columns, row_format))
+
+  def count(self, table, where_row_list=None):
+    '''
+    Returns the number of rows in table matching where_row_list,
+    counted by sqlite.
+    '''
+    where_chunks = DbAccessor.split_where_in(where_row_list, self.max_variables)
+    if len(where_chunks) > 1:
+      # the IN values are made unique before chunking, so no row is
+      # counted twice
+      return sum(self.count(table, where_chunk) for where_chunk in where_chunks)
+
+    return self.aggregate(table, None, {'*': 'count'}, where_row_list, row_format='tuple')[0][0]
+
+  @staticmethod
+  def mkexists(table, where_row_list=None):
+    (where_clause, value_list) = DbAccessor.mk_where_clause(where_row_list)
+    stmt = "SELECT EXISTS (SELECT 1 FROM " + table + where_clause + ");"
+    return stmt, value_list
+
+  def exists(self, table, where_row_list=None):
+    '''
+    Returns True if any row of table matches where_row_list. sqlite
+    stops at the first matching row.
+    '''
+    where_chunks = DbAccessor.split_where_in(where_row_list, self.max_variables)
+    if len(where_chunks) > 1:
+      return any(self.exists(table, where_chunk) for where_chunk in where_chunks)
+
+    if self.validate:
+      self.check_query(('exists', table, DbAccessor.get_where_shape(where_row_list)), table, None, where_row_list)
+
+    (stmt, value_list) = DbAccessor.mkexists(table, where_row_list)
+    return bool(self.get_row_list_with_execute(stmt, value_list)[0][0])
+
+
+
+  @staticmethod
+  def mk_conflict_clauses(cols, on_conflict=None, conflict_cols=None, update_cols=None):
+    '''
+    Returns the (<insert verb>, <upsert clause>) pair for on_conflict:
+
+    None      -- 'INSERT INTO', no clause
+    'ignore'  -- 'INSERT OR IGNORE INTO': rows that would violate a
+                 unique or primary key constraint are skipped
+    'replace' -- 'INSERT OR REPLACE INTO': the conflicting row is
+                 deleted and the new row inserted
+    'update'  -- 'INSERT INTO' ... ON CONFLICT (conflict_cols) DO UPDATE
+                 SET <col> = excluded.<col> for each of update_cols
+                 (default: every inserted column not in conflict_cols)
+    '''
+    valid_on_conflict = (None, 'ignore', 'replace', 'update')
+    if on_conflict not in valid_on_conflict:
+      raise DbAccessorError('bad on_conflict: %s' % on_conflict)
+
+    if on_conflict == 'ignore': return 'INSERT OR IGNORE INTO ', ''
+    if on_conflict == 'replace': return 'INSERT OR REPLACE INTO ', ''
+    if on_conflict is None: return 'INSERT INTO ', ''
+
+    if not conflict_cols:
+      raise DbAccessorError("on_conflict='update' needs conflict_cols")
+
+    if not update_cols:
+      update_cols = [col for col in cols if col not in conflict_cols]
+
+    clause = '\nON CONFLICT (' + ', '.join(conflict_cols) + ')'
+    if update_cols:
+      clause += ' DO UPDATE SET '
+      clause += ', '.join(['%s = excluded.%s' % (col, col) for col in update_cols])
+    else:
+      clause += ' DO NOTHING'
+
+    return 'INSERT INTO ', clause
+
+
+  @staticmethod
+  def mkinsert(table, values, on_conflict=None, conflict_cols=None, update_cols=None):
     # build list of column names
     cols = values[0].keys()
 
-    stmt = 'INSERT INTO ' + table + ' ('
+    (verb, conflict_clause) = DbAccessor.mk_conflict_clauses(cols, on_conflict, conflict_cols, update_cols)
+
+    stmt = verb + table + ' ('
     stmt += ', '.join(cols)
     stmt += ') VALUES ('
     stmt += ', '.join([":%s" % col for col in cols])
     stmt += ')'
+    stmt += conflict_clause
     stmt += ';'
 
     return(stmt)    
 
 
-  def insert(self, table, values):
+  def insert(self, table, values, on_conflict=None, conflict_cols=None, update_cols=None):
     '''
     Executes an INSERT statement against table.
 
@@ -485,9 +2880,534 @@ class DbAccessor(object):
     table           -- name of the table to be written to
     values          -- list of rows (dicts) to be inserted
 
+    on_conflict (optional)   -- what to do with a row that violates a
+                                unique constraint: None (raise
+                                IntegrityError), 'ignore', 'replace'
+                                or 'update' (upsert)
+    conflict_cols (optional) -- for 'update': the unique column(s)
+                                that identify a row, e.g. ['ticker']
+    update_cols (optional)   -- for 'update': columns to overwrite on
+                                conflict (default: all other columns)
+
+    e.g. db.insert('stocks', rows, on_conflict='update', conflict_cols=['ticker'])
+
     Returns: None
     '''
-    stmt = DbAccessor.mkinsert(table, values)
+    self.check_writable()
+    stmt = self.cached_mkinsert(table, values, on_conflict, conflict_cols, update_cols)
     self.executemany(stmt, values)
 
 
+  @staticmethod
+  def mkinsert_positional(table, columns, on_conflict=None, conflict_cols=None, update_cols=None):
+    (verb, conflict_clause) = DbAccessor.mk_conflict_clauses(columns, on_conflict, conflict_cols, update_cols)
+
+    stmt = verb + table + ' ('
+    stmt += ', '.join(columns)
+    stmt += ') VALUES ('
+    stmt += ', '.join(['?'] * len(columns))
+    stmt += ')'
+    stmt += conflict_clause
+    stmt += ';'
+
+    return(stmt)
+
+
+  def get_index_sql_list(self, table):
+    # [(<index name>, <create index sql>), ...] for the indexes that can
+    # be dropped and recreated during a load: non-unique ones with sql.
+    # Unique indexes stay, so uniqueness and ON CONFLICT keep working,
+    # and the automatic constraint indexes have null sql anyway.
+    stmt = ("SELECT il.name, m.sql FROM pragma_index_list(?) AS il "
+      "JOIN sqlite_master AS m ON m.type = 'index' AND m.name = il.name "
+      "WHERE il.\"unique\" = 0 AND m.sql IS NOT NULL")
+    return [(row[0], row[1]) for row in self.get_row_list_with_execute(stmt, [table])]
+
+
+  def bulk_insert(self, table, rows, columns=None, chunk_size=10000, defer_indexes=False, progress=None,
+      on_conflict=None, conflict_cols=None, update_cols=None):
+    '''
+    Inserts a large number of rows in one transaction.
+
+    Arguments:
+    table           -- name of the table to be written to
+    rows            -- any iterable (list, generator, ...) of dicts or
+                       of tuples; it is consumed chunk_size rows at a
+                       time, so it never has to fit in memory
+    columns (optional)    -- column names. Taken from the first row when
+                       rows are dicts, and from the table (all columns,
+                       in order) when rows are tuples.
+    chunk_size (optional) -- rows handed to each executemany call
+    defer_indexes (optional) -- drop the table's non-unique secondary
+                       indexes (those made with create_index(...,
+                       unique=False) or CREATE INDEX) before the load and
+                       rebuild them afterwards. Unique indexes are kept,
+                       so duplicates fail (or hit on_conflict) as they
+                       are inserted.
+    progress (optional)   -- callable progress(rows_so_far, seconds)
+                       called after each chunk
+    on_conflict, conflict_cols, update_cols (optional) -- as for insert
+
+    Returns: dict with 'rows', 'chunks', 'seconds' and 'rows_per_sec'.
+    If anything fails, the whole load (and any index drop) is rolled back.
+    '''
+    self.check_writable()
+    if chunk_size < 1:
+      raise DbAccessorError('bad chunk_size: %s' % chunk_size)
+
+    rows = iter(rows)
+    first = next(rows, None)
+    stats = {'rows': 0, 'chunks': 0, 'seconds': 0.0, 'rows_per_sec': 0.0}
+    if first is None: return stats
+
+    rows = itertools.chain([first], rows)
+
+    if isinstance(first, dict):
+      if not columns: columns = list(first.keys())
+      getter = operator.itemgetter(*columns)
+      if len(columns) == 1:
+        rows = ((getter(row),) for row in rows)
+      else:
+        rows = (getter(row) for row in rows)
+
+    elif not columns:
+      columns = self.get_field_names(table)
+
+    if self.validate:
+      key = ('bulk_insert', table, tuple(columns), on_conflict, tuple(conflict_cols or ()), tuple(update_cols or ()))
+      self.check_query(key, table, key[2] + key[4] + key[5])
+
+    stmt = DbAccessor.mkinsert_positional(table, columns, on_conflict, conflict_cols, update_cols)
+
+    start = time.time()
+    with self.transaction():
+      index_sql_list = self.get_index_sql_list(table) if defer_indexes else []
+      for index_name, _ in index_sql_list:
+        self.execute('drop index %s' % index_name)
+
+      while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk: break
+
+        self.executemany(stmt, chunk)
+        stats['rows'] += len(chunk)
+        stats['chunks'] += 1
+        if progress: progress(stats['rows'], time.time() - start)
+
+      for _, index_sql in index_sql_list:
+        self.execute(index_sql)
+
+    stats['seconds'] = time.time() - start
+    if stats['seconds'] > 0:
+      stats['rows_per_sec'] = stats['rows'] / stats['seconds']
+
+    return stats
+
+
+  #---------- Export and Import ----------------------------
+
+  @staticmethod
+  def get_file_format(path, file_format=None, compress=None):
+    # (file_format, compress) from the arguments, or from the file name:
+    # .csv or .jsonl/.ndjson, optionally followed by .gz
+    name = path.lower()
+    if compress is None: compress = name.endswith('.gz')
+    if name.endswith('.gz'): name = name[:-3]
+
+    if file_format is None:
+      if name.endswith('.csv'): file_format = 'csv'
+      elif name.endswith('.jsonl') or name.endswith('.ndjson'): file_format = 'jsonl'
+      else: raise DbAccessorError('cannot tell the format of %s; pass format=' % path)
+
+    if file_format not in ('csv', 'jsonl'):
+      raise DbAccessorError('bad format: %s' % file_format)
+
+    return file_format, compress
+
+  @staticmethod
+  def open_text(path, mode, compress):
+    # csv wants newline='' so it can write and read its own line endings
+    if compress: return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+  def export(self, table, path, format=None, where_row_list=None, columns=None, sort_cols=None,
+      batch_size=10000, compress=None, progress=None):
+    '''
+    Writes the rows of table to a CSV or JSON Lines file, streaming
+    them from the cursor batch_size at a time.
+
+    Arguments:
+    table           -- name of the table to be read
+    path            -- file to write
+    format (optional)     -- 'csv' (with a header line) or 'jsonl' (one
+                          object per line); by default from the file
+                          name: .csv, .jsonl or .ndjson
+    where_row_list, columns, sort_cols (optional) -- as for read
+    compress (optional)   -- gzip the file; by default when path ends
+                          with .gz
+    progress (optional)   -- callable progress(rows_so_far, seconds)
+                          called after each batch
+
+    NULL is written as an empty CSV field and as JSON null; blobs are
+    written base64 encoded.
+
+    Returns: dict with 'rows', 'seconds' and 'rows_per_sec'.
+    '''
+    (file_format, compress) = DbAccessor.get_file_format(path, format, compress)
+    if not columns: columns = self.get_field_names(table)
+
+    stats = {'rows': 0, 'seconds': 0.0, 'rows_per_sec': 0.0}
+    start = time.time()
+
+    encode = lambda value: base64.b64encode(value).decode('ascii') if isinstance(value, bytes) else value
+
+    with DbAccessor.open_text(path, 'w', compress) as f:
+      if file_format == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        write_row = lambda row: writer.writerow([encode(value) for value in row])
+      else:
+        write_row = lambda row: f.write(json.dumps(dict(zip(columns, map(encode, row)))) + '\n')
+
+      for row in self.read_iter(table, columns, where_row_list, sort_cols, batch_size, row_format='tuple'):
+        write_row(row)
+        stats['rows'] += 1
+        if progress and stats['rows'] % batch_size == 0: progress(stats['rows'], time.time() - start)
+
+    stats['seconds'] = time.time() - start
+    if progress and stats['rows'] % batch_size: progress(stats['rows'], stats['seconds'])
+    if stats['seconds'] > 0:
+      stats['rows_per_sec'] = stats['rows'] / stats['seconds']
+
+    return stats
+
+  @staticmethod
+  def to_number(value):
+    try:
+      return int(value)
+    except ValueError:
+      try:
+        return float(value)
+      except ValueError:
+        return value
+
+  @staticmethod
+  def get_import_converter(field_type, from_text):
+    # converts a value read from a file to the column's type, following
+    # sqlite's column affinity rules. CSV fields are all text, so every
+    # empty field is read as NULL; JSON values already have their types
+    # and only blobs need decoding.
+    field_type = (field_type or '').upper()
+
+    if 'BLOB' in field_type:
+      convert = lambda value: base64.b64decode(value) if isinstance(value, str) else value
+    elif not from_text or not field_type or any(s in field_type for s in ('CHAR', 'CLOB', 'TEXT')):
+      convert = lambda value: value
+    else:
+      convert = DbAccessor.to_number
+
+    if from_text: return lambda value: None if value == '' else convert(value)
+    return convert
+
+  def import_(self, path, table, format=None, columns=None, chunk_size=10000, compress=None, progress=None,
+      defer_indexes=False, on_conflict=None, conflict_cols=None, update_cols=None):
+    '''
+    Loads a CSV or JSON Lines file (as written by export) into an
+    existing table with bulk_insert, reading the file as it goes, so
+    memory use does not grow with the file.
+
+    Arguments:
+    path            -- file to read
+    table           -- name of the table to be written to
+    format, compress (optional) -- as for export
+    columns (optional)    -- columns to load; by default the CSV header,
+                          or the keys of the first JSON object. Keys
+                          missing from a JSON object are loaded as NULL.
+    chunk_size, progress, defer_indexes, on_conflict, conflict_cols,
+    update_cols (optional) -- as for bulk_insert
+
+    Values are converted to the types in get_field_name_type_list.
+
+    Returns: the bulk_insert stats dict.
+    '''
+    self.check_writable()
+    (file_format, compress) = DbAccessor.get_file_format(path, format, compress)
+
+    type_dict = dict(self.get_field_name_type_list(table))
+    if not type_dict:
+      raise DbAccessorError('table %s not found' % table)
+
+    with DbAccessor.open_text(path, 'r', compress) as f:
+      if file_format == 'csv':
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None: return self.bulk_insert(table, [], columns)
+
+        if not columns: columns = header
+        for col_name in columns:
+          if col_name not in header:
+            raise DbAccessorError('column %s is not in the header of %s' % (col_name, path))
+        index_list = [header.index(col_name) for col_name in columns]
+        rows = ([row[i] for i in index_list] for row in reader)
+
+      else:
+        dict_rows = (json.loads(line) for line in f if line.strip())
+        first = next(dict_rows, None)
+        if first is None: return self.bulk_insert(table, [], columns)
+
+        if not columns: columns = list(first.keys())
+        rows = ([row.get(col_name) for col_name in columns] for row in itertools.chain([first], dict_rows))
+
+      converters = [DbAccessor.get_import_converter(type_dict.get(col_name), file_format == 'csv')
+        for col_name in columns]
+      rows = (tuple(convert(value) for convert, value in zip(converters, row)) for row in rows)
+
+      return self.bulk_insert(table, rows, columns, chunk_size, defer_indexes, progress,
+        on_conflict, conflict_cols, update_cols)
+
+
+
+
+#---------- Parallel read workers ------------------------
+# run in the worker processes of DbAccessor.parallel_read
+
+parallel_read_db = None
+
+def parallel_read_init(dbpath, db_kwargs):
+  # opens the worker process's own read-only accessor
+  global parallel_read_db
+  parallel_read_db = DbAccessor(dbpath, **db_kwargs)
+
+def parallel_read_worker(table, columns, where_row_list, sort_cols, row_format, func):
+  rows = parallel_read_db.read(table, columns, where_row_list, sort_cols, row_format=row_format)
+  return rows if func is None else func(rows)
+
+
+
+
+class AsyncDbAccessor(object):
+  '''
+  asyncio front end for DbAccessor. Each coroutine runs the matching
+  DbAccessor method on an executor thread, so the event loop is never
+  blocked by sqlite. Requests are queued on the executor and run in
+  order. max_pending (optional) bounds how many are handed to the
+  executor at once; callers beyond it wait in the event loop, without
+  a limit, until an earlier request finishes.
+
+  With workers=1 (the default) one dedicated thread owns an ordinary
+  DbAccessor. With workers > 1 the DbAccessor is opened in pooled mode
+  (pool_size defaults to workers), so reads can run in parallel.
+
+  Other keyword arguments are passed on to DbAccessor.
+
+  async with AsyncDbAccessor('definer.db') as db:
+    rows = await db.read('stocks', where_row_list=[('beta', '>', 1.0)])
+
+    async for row in db.read_iter('stocks', batch_size=1000):
+      print(row)
+  '''
+  def __init__(self, dbpath, workers=1, max_pending=None, **kwargs):
+    if workers < 1:
+      raise DbAccessorError('bad number of workers: %s' % workers)
+
+    if workers > 1: kwargs.setdefault('pool_size', workers)
+
+    self.dbpath = dbpath
+    self.workers = workers
+    self.max_pending = max_pending
+    self.semaphore = None
+
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    # the accessor is opened on an executor thread, so a non-pooled
+    # connection belongs to the thread that will run every request
+    self.db_future = self.executor.submit(DbAccessor, dbpath, **kwargs)
+
+
+  async def __aenter__(self):
+    await asyncio.wrap_future(self.db_future)
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.close()
+
+
+  def call_db(self, method_name, args, kwargs):
+    # runs on an executor thread
+    db = self.db_future.result()
+    return getattr(db, method_name)(*args, **kwargs)
+
+
+  async def run(self, func, *args, **kwargs):
+    '''
+    Runs func(*args, **kwargs) on the executor and returns its result.
+    '''
+    if self.max_pending and self.semaphore is None:
+      self.semaphore = asyncio.Semaphore(self.max_pending)
+
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+
+    if self.semaphore is None:
+      return await loop.run_in_executor(self.executor, call)
+
+    async with self.semaphore:
+      return await loop.run_in_executor(self.executor, call)
+
+
+  async def call(self, method_name, *args, **kwargs):
+    '''
+    Awaits DbAccessor.<method_name>(*args, **kwargs) on the executor.
+    '''
+    return await self.run(self.call_db, method_name, args, kwargs)
+
+
+  async def close(self):
+    try:
+      await self.call('close')
+    finally:
+      self.executor.shutdown(wait=False)
+
+
+  #---------- Data Definition Methods ----------------------
+
+  async def create_table(self, table_name, field_names_types):
+    return await self.call('create_table', table_name, field_names_types)
+
+  async def drop_table(self, table_name):
+    return await self.call('drop_table', table_name)
+
+  async def create_index(self, table_name, index_field_name, **kwargs):
+    return await self.call('create_index', table_name, index_field_name, **kwargs)
+
+  async def drop_index(self, table_name, index_field_name, index_name=None):
+    return await self.call('drop_index', table_name, index_field_name, index_name)
+
+  async def analyze(self, table_name=None, optimize=True):
+    return await self.call('analyze', table_name, optimize)
+
+
+  #---------- Schema Examination Methods -------------------
+
+  async def get_table_names(self):
+    return await self.call('get_table_names')
+
+  async def get_field_names(self, table_name):
+    return await self.call('get_field_names', table_name)
+
+  async def get_dbschema(self):
+    return await self.call('get_dbschema')
+
+  async def get_dbschema_detail(self):
+    return await self.call('get_dbschema_detail')
+
+  async def get_db_validator(self):
+    return await self.call('get_db_validator')
+
+
+  #---------  Data Access Methods (CRUD) -------------------
+
+  async def execute(self, stmt, params=[]):
+    '''
+    Executes stmt and returns the list of result rows (a cursor can
+    not be handed back across threads).
+    '''
+    return await self.call('get_row_list_with_execute', stmt, params)
+
+  async def insert(self, table, values, on_conflict=None, conflict_cols=None, update_cols=None):
+    return await self.call('insert', table, values, on_conflict, conflict_cols, update_cols)
+
+  async def read(self, table, columns=None, where_row_list=None, sort_cols=None, limit=None, offset=None,
+      row_format=None):
+    return await self.call('read', table, columns, where_row_list, sort_cols, limit, offset, row_format)
+
+  async def read_page(self, table, columns=None, where_row_list=None, sort_cols=None, page_size=100, cursor=None,
+      row_format=None):
+    return await self.call('read_page', table, columns, where_row_list, sort_cols, page_size, cursor, row_format)
+
+  async def read_columns(self, table, columns=None, where_row_list=None, sort_cols=None, limit=None, offset=None,
+      batch_size=10000, use_numpy=None):
+    return await self.call('read_columns', table, columns, where_row_list, sort_cols, limit, offset,
+      batch_size, use_numpy)
+
+  async def parallel_read(self, table, columns=None, where_row_list=None, sort_cols=None, workers=None, **kwargs):
+    return await self.call('parallel_read', table, columns, where_row_list, sort_cols, workers, **kwargs)
+
+  async def update(self, table, set_row, where_row_list):
+    return await self.call('update', table, set_row, where_row_list)
+
+  async def delete(self, table, where_row_list=None):
+    return await self.call('delete', table, where_row_list)
+
+  async def bulk_insert(self, table, rows, **kwargs):
+    return await self.call('bulk_insert', table, rows, **kwargs)
+
+  async def export(self, table, path, **kwargs):
+    return await self.call('export', table, path, **kwargs)
+
+  async def import_(self, path, table, **kwargs):
+    return await self.call('import_', path, table, **kwargs)
+
+  async def update_many(self, table, rows, key_cols, chunk_size=10000):
+    return await self.call('update_many', table, rows, key_cols, chunk_size)
+
+  async def delete_many(self, table, key_col, values, chunk_size=10000):
+    return await self.call('delete_many', table, key_col, values, chunk_size)
+
+  async def aggregate(self, table, group_by=None, aggs=None, where_row_list=None, having=None, sort_cols=None,
+      row_format=None):
+    return await self.call('aggregate', table, group_by, aggs, where_row_list, having, sort_cols, row_format)
+
+  async def count(self, table, where_row_list=None):
+    return await self.call('count', table, where_row_list)
+
+  async def exists(self, table, where_row_list=None):
+    return await self.call('exists', table, where_row_list)
+
+
+  async def run_in_transaction(self, func, mode=None):
+    '''
+    Runs func(db) on the executor inside db.transaction(mode), where
+    db is the underlying DbAccessor, and returns func's result.
+    '''
+    def in_transaction(db):
+      with db.transaction(mode):
+        return func(db)
+
+    db = await asyncio.wrap_future(self.db_future)
+    return await self.run(in_transaction, db)
+
+
+  async def read_iter(self, table, columns=None, where_row_list=None, sort_cols=None, batch_size=1000,
+      row_format=None):
+    '''
+    Async generator version of DbAccessor.read_iter. Rows are fetched
+    batch_size at a time on an executor thread, and the next batch is
+    only fetched once the caller has consumed the current one.
+    '''
+    db = await asyncio.wrap_future(self.db_future)
+
+    # a generator must be advanced on one thread: use the executor
+    # itself when it has a single thread, otherwise a private one
+    if self.workers == 1:
+      executor = self.executor
+    else:
+      executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    loop = asyncio.get_running_loop()
+    gen = db.read_iter(table, columns, where_row_list, sort_cols, batch_size, row_format=row_format)
+
+    def next_batch():
+      return list(itertools.islice(gen, batch_size))
+
+    try:
+      while True:
+        batch = await loop.run_in_executor(executor, next_batch)
+        if not batch: break
+
+        for row in batch:
+          yield row
+
+    finally:
+      await loop.run_in_executor(executor, gen.close)
+      if executor is not self.executor: executor.shutdown(wait=False)
@@ -0,0 +1,289 @@
+#dbaccessor_bench.py
+'''
+Benchmarks for the DbAccessor CRUD methods and SQL builders.
+
+  python dbaccessor_bench.py run --rows 10000 100000 --batch-sizes 100 1000 \
+      --profiles default fast-write --out new.json
+  python dbaccessor_bench.py compare old.json new.json
+
+run builds a synthetic stocks table for every (rows, profile) pair and
+times each case; compare matches the cases of two result files and
+reports the ones that got slower by more than --threshold.
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dbaccessor import DbAccessor
+
+
+TABLE = 'stocks'
+
+FIELD_NAMES_TYPES = [
+  ('id', 'integer primary key autoincrement not null'),
+  ('ticker', 'text unique'), ('industry', 'text'),
+  ('beta', 'numeric'), ('price', 'numeric')]
+
+INDUSTRIES = ['technology', 'transportation', 'energy', 'finance', 'health',
+  'retail', 'utilities', 'materials']
+
+
+#-----------  Synthetic data ------------------------------
+
+def mk_ticker(i, prefix='t'):
+  return '%s%08d' % (prefix, i)
+
+def gen_rows(count, seed=0, prefix='t'):
+  # the same seed always gives the same rows, a tuple per row in
+  # (ticker, industry, beta, price) order
+  rng = random.Random(seed)
+  for i in range(count):
+    yield (mk_ticker(i, prefix), rng.choice(INDUSTRIES),
+      round(rng.uniform(0.2, 2.5), 2), round(rng.uniform(1, 500), 2))
+
+def create_stocks(db, rows, seed=0, chunk_size=10000):
+  db.create_table(TABLE, FIELD_NAMES_TYPES)
+  db.create_index(TABLE, 'industry', unique=False)
+  return db.bulk_insert(TABLE, gen_rows(rows, seed), ['ticker', 'industry', 'beta', 'price'],
+    chunk_size=chunk_size, defer_indexes=True)
+
+
+#-----------  Measurement ---------------------------------
+
+def percentile(sorted_samples, p):
+  # nearest-rank percentile of an already sorted list
+  if not sorted_samples: return None
+  k = max(0, min(len(sorted_samples) - 1, int(round(p / 100.0 * len(sorted_samples) + 0.5)) - 1))
+  return sorted_samples[k]
+
+def summarize(samples, ops_per_sample=1, rows_per_sample=None):
+  samples = sorted(samples)
+  total = sum(samples)
+  result = {'samples': len(samples), 'seconds': total,
+    'p50': percentile(samples, 50), 'p90': percentile(samples, 90),
+    'p99': percentile(samples, 99), 'max': samples[-1] if samples else None,
+    'ops_per_sec': len(samples) * ops_per_sample / total if total else None}
+  if rows_per_sample is not None:
+    result['rows_per_sec'] = len(samples) * rows_per_sample / total if total else None
+  return result
+
+def time_calls(func, samples, setup=None, inner=1):
+  # seconds per call of func(), one entry per sample; with inner > 1
+  # each sample is the mean of inner back-to-back calls
+  times = []
+  for i in range(samples):
+    arg = setup(i) if setup else None
+    start = time.perf_counter()
+    for _ in range(inner):
+      func(arg) if setup else func()
+    times.append((time.perf_counter() - start) / inner)
+  return times
+
+def peak_memory(func, setup=None, i=0):
+  # peak bytes allocated by Python during one untimed call of func;
+  # setup(i) makes its argument
+  arg = setup(i) if setup else None
+  tracemalloc.start()
+  try:
+    func(arg) if setup else func()
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+
+class Runner(object):
+  '''
+  Collects one result dict per benchmark case. The case key is
+  (name, rows, batch_size, profile); compare matches on it.
+  '''
+  def __init__(self, samples, memory=True, verbose=True):
+    self.samples = samples
+    self.memory = memory
+    self.verbose = verbose
+    self.results = []
+
+  def case(self, name, func, rows=None, batch_size=None, profile=None, samples=None,
+      setup=None, inner=1, rows_per_sample=None):
+    samples = samples or self.samples
+    times = time_calls(func, samples, setup, inner)
+    result = {'name': name, 'rows': rows, 'batch_size': batch_size, 'profile': profile}
+    result.update(summarize(times, 1, rows_per_sample))
+    # the memory pass gets a setup argument of its own, after the timed ones
+    if self.memory: result['peak_memory'] = peak_memory(func, setup, samples)
+
+    self.results.append(result)
+    if self.verbose: print(format_result(result))
+    return result
+
+
+def format_result(result):
+  line = '%-16s rows=%-9s batch=%-6s profile=%-11s p50=%9.1fus p99=%9.1fus %12.1f ops/s' % (
+    result['name'], result['rows'], result['batch_size'], result['profile'],
+    result['p50'] * 1e6, result['p99'] * 1e6, result['ops_per_sec'] or 0)
+  if result.get('rows_per_sec'): line += ' %12.1f rows/s' % result['rows_per_sec']
+  if 'peak_memory' in result: line += ' peak=%dKiB' % (result['peak_memory'] // 1024)
+  return line
+
+
+#-----------  Benchmark cases -----------------------------
+
+def bench_builders(runner, samples, inner=1000):
+  # the SQL builders do not touch the database
+  where_row_list = [('industry', '=', 'technology'), ('beta', '>', 1.0),
+    ('price', 'BETWEEN', (10, 50)), ('ticker', 'IN', ['t1', 't2', 't3'])]
+  sort_cols = [('industry', 'DESC'), ('ticker', 'ASC')]
+  columns = ['ticker', 'industry', 'beta', 'price']
+  values = [{'ticker': 'ibm', 'industry': 'technology', 'beta': 1.1, 'price': 56}]
+
+  runner.case('mkselect', lambda: DbAccessor.mkselect(TABLE, columns, where_row_list, sort_cols, 100),
+    samples=samples, inner=inner)
+  runner.case('mk_where_clause', lambda: DbAccessor.mk_where_clause(where_row_list),
+    samples=samples, inner=inner)
+  runner.case('mkinsert', lambda: DbAccessor.mkinsert(TABLE, values), samples=samples, inner=inner)
+
+def bench_table(runner, dbpath, rows, batch_sizes, profile, samples, seed=0):
+  db = DbAccessor(dbpath, profile=profile)
+  label = profile or 'default'
+
+  # loading the table is its own case, timed once
+  start = time.perf_counter()
+  create_stocks(db, rows, seed)
+  seconds = time.perf_counter() - start
+  result = {'name': 'bulk_insert', 'rows': rows, 'batch_size': 10000, 'profile': label}
+  result.update(summarize([seconds], 1, rows))
+  runner.results.append(result)
+  if runner.verbose: print(format_result(result))
+
+  rng = random.Random(seed + 1)
+  point_ticker = lambda i: mk_ticker(rng.randrange(rows))
+
+  runner.case('read_point', lambda ticker: db.read(TABLE, None, [('ticker', '=', ticker)]),
+    rows, None, label, setup=point_ticker)
+  runner.case('update_point', lambda ticker: db.update(TABLE, {'price': 1.0}, [('ticker', '=', ticker)]),
+    rows, None, label, setup=point_ticker)
+
+  scan_samples = max(1, samples // 20)
+  for batch_size in batch_sizes:
+    runner.case('read_range', lambda: db.read(TABLE, None, [('industry', '=', 'energy')], limit=batch_size),
+      rows, batch_size, label, rows_per_sample=batch_size)
+
+    runner.case('read_iter_scan', lambda: sum(1 for _ in db.read_iter(TABLE, batch_size=batch_size)),
+      rows, batch_size, label, samples=scan_samples, rows_per_sample=rows)
+
+    # insert a batch of new rows, then delete the same batch
+    new_batch = lambda i: [dict(zip(('ticker', 'industry', 'beta', 'price'), row))
+      for row in gen_rows(batch_size, seed + i, 'n%d_' % i)]
+    batch_tickers = lambda i: [mk_ticker(j, 'n%d_' % i) for j in range(batch_size)]
+
+    runner.case('insert', lambda values: db.insert(TABLE, values), rows, batch_size, label,
+      setup=new_batch, rows_per_sample=batch_size)
+    runner.case('delete', lambda tickers: db.delete(TABLE, [('ticker', 'IN', tickers)]), rows, batch_size,
+      label, setup=batch_tickers, rows_per_sample=batch_size)
+
+  db.close()
+
+def run(args):
+  runner = Runner(args.samples, memory=not args.no_memory, verbose=not args.quiet)
+
+  bench_builders(runner, args.samples)
+
+  tmp_dir = tempfile.mkdtemp(prefix='dbaccessor_bench_', dir=args.dbdir)
+  try:
+    for rows in args.rows:
+      for profile in args.profiles:
+        dbpath = os.path.join(tmp_dir, 'bench_%d_%s.db' % (rows, profile))
+        bench_table(runner, dbpath, rows, args.batch_sizes, None if profile == 'default' else profile,
+          args.samples, args.seed)
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+  output = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+    'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(), 'argv': sys.argv[1:]},
+    'results': runner.results}
+
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(output, f, indent=2)
+    print('results written to %s' % args.out)
+
+  return output
+
+
+#-----------  Comparing runs ------------------------------
+
+def result_key(result):
+  return (result['name'], result['rows'], result['batch_size'], result['profile'])
+
+def compare(old_output, new_output, threshold=0.1):
+  '''
+  Returns [(key, old_p50, new_p50, change), ...] for the cases found in
+  both runs, where change is new_p50 / old_p50 - 1, and the list of
+  cases whose change is above threshold (slower).
+  '''
+  old_dict = dict((result_key(r), r) for r in old_output['results'])
+
+  rows = []
+  for new in new_output['results']:
+    old = old_dict.get(result_key(new))
+    if old is None or not old['p50']: continue
+    rows.append((result_key(new), old['p50'], new['p50'], new['p50'] / old['p50'] - 1))
+
+  regressions = [row for row in rows if row[3] > threshold]
+  return rows, regressions
+
+def print_compare(args):
+  with open(args.old) as f: old_output = json.load(f)
+  with open(args.new) as f: new_output = json.load(f)
+
+  rows, regressions = compare(old_output, new_output, args.threshold)
+  for key, old_p50, new_p50, change in rows:
+    flag = '  SLOWER' if change > args.threshold else ''
+    print('%-16s rows=%-9s batch=%-6s profile=%-11s p50 %9.1fus -> %9.1fus %+7.1f%%%s' % (
+      key + (old_p50 * 1e6, new_p50 * 1e6, change * 100, flag)))
+
+  print('%d cases compared, %d slower by more than %d%%' % (len(rows), len(regressions), args.threshold * 100))
+  return 1 if regressions else 0
+
+
+def main():
+  parser = argparse.ArgumentParser(description='DbAccessor benchmarks')
+  sub = parser.add_subparsers(dest='command', required=True)
+
+  run_parser = sub.add_parser('run', help='run the benchmarks')
+  run_parser.add_argument('--rows', type=int, nargs='+', default=[10000],
+    help='table sizes, e.g. 10000 1000000 10000000')
+  run_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 1000],
+    help='rows per insert/delete batch, read limit and read_iter batch_size')
+  run_parser.add_argument('--profiles', nargs='+', default=['default'],
+    choices=['default'] + sorted(DbAccessor.PRAGMA_PROFILES), help='PRAGMA profiles')
+  run_parser.add_argument('--samples', type=int, default=200, help='timed calls per case')
+  run_parser.add_argument('--seed', type=int, default=0)
+  run_parser.add_argument('--dbdir', default=None, help='directory for the scratch databases')
+  run_parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc peak memory pass')
+  run_parser.add_argument('--quiet', action='store_true')
+  run_parser.add_argument('--out', help='write the results to this JSON file')
+
+  compare_parser = sub.add_parser('compare', help='compare two result files')
+  compare_parser.add_argument('old')
+  compare_parser.add_argument('new')
+  compare_parser.add_argument('--threshold', type=float, default=0.1,
+    help='report cases whose p50 grew by more than this fraction')
+
+  args = parser.parse_args()
+  if args.command == 'run':
+    run(args)
+    return 0
+  return print_compare(args)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,5 +1,13 @@
 #dbaccessor_tests.py
-from dbaccessor import DbAccessor, DbSchemaValidatorError
+import asyncio
+import json
+import operator
+import os
+import shutil
+import tempfile
+import threading
+
+from dbaccessor import AsyncDbAccessor, DbAccessor, DbAccessorError, DbSchemaValidatorError
 
 #--------------  test get_field_definition_list -------
 def t_get_field_definition_list(db, table_name):
@@ -64,6 +72,10 @@ def t_mkinsert(cls, table):
 
   print("t_mkinsert SQL:\n" + stmt)
 
+  stmt = cls.mkinsert(table, initial_values, 'update', ['ticker'])
+
+  print("t_mkinsert upsert SQL:\n" + stmt)
+
 
 #----------   Data Definition Tests -------------------------
 
@@ -92,12 +104,55 @@ def t_create_drop_index(db, table_name):
   print("\n--------------------")
 
 
+def t_composite_index(db, table_name):
+  print("\n--------------------")
+  print("test of composite, partial and covering indexes")
+
+  db.create_index(table_name, ['industry', ('price', 'DESC')], unique=False, include_cols=['ticker'])
+  db.create_index(table_name, 'ticker', where_row_list=[('beta', '>', 1.0), ('industry', '!=', "o'neil")],
+    if_not_exists=True, index_name='high_beta_ticker_index')
+  db.create_index(table_name, 'ticker', where_row_list=[('beta', '>', 1.0)],
+    if_not_exists=True, index_name='high_beta_ticker_index')
+  db.analyze(table_name)
+
+  for name, sql in db.get_index_sql_list(table_name): print(sql)
+
+  db.drop_index(table_name, ['industry', 'price'])
+  db.drop_index(table_name, None, index_name='high_beta_ticker_index')
+  print(db.get_index_names())
+  print("\n--------------------")
+
+
 def print_schema(db):
   print("\n----- display dbschema ---------")
   db.display_dbschema()
   print("\n--------------------------")   
 
 
+def t_schema_cache(dbpath, table_name):
+  print("\n----- schema cache ---------")
+  db = DbAccessor(dbpath, watch_schema_version=True)
+
+  print("field names: %s" % db.get_field_names(table_name))
+  print("cached tables: %s" % list(db.field_names_cache.keys()))
+
+  db.conn.execute("create table if not exists cache_probe (a text)")
+  print("after raw create table, cached tables: %s" % db.get_table_names())
+
+  db.conn.execute("drop table if exists cache_probe")
+  print("after raw drop table, cached tables: %s" % db.get_table_names())
+  db.close()
+
+  # without watch_schema_version, get_dbschema must not mix two caches
+  db = DbAccessor(dbpath)
+  db.get_dbschema_detail()
+  db.execute("create table if not exists cache_probe (a text)")
+  print("get_dbschema after raw create table: %s" % sorted(db.get_dbschema().keys()))
+  db.execute("drop table if exists cache_probe")
+  db.close()
+  print("\n--------------------------")
+
+
 #-----------  DbSchema Validation Tests ------------------ 
 
 def test_db_validator(db): 
@@ -159,6 +214,18 @@ def test_db_validator(db):
 
   t_does_is_field_crash(dbv, invalid_table_name, valid_field_name)
 
+  print("------------  validate_query ---------------\n")
+  where_row_list = [('OR', [[('ticker', '=', 'ibm')], [('rowid', '>', 2)]])]
+  print("valid query: %s" % dbv.validate_query(valid_table_name, ['ticker', 'price'], where_row_list,
+    [('price', 'DESC')]))
+  try:
+    dbv.validate_query(valid_table_name, ['ticker'], [('OR', [[(invalid_field_name, '=', 1)]])])
+  except DbSchemaValidatorError as error:
+    print("DbSchemaValidatorError: %s" % error)
+
+  print("\n------------  get_dbschema_detail ---------------\n")
+  print(json.dumps(db.get_dbschema_detail()[valid_table_name], indent=2, sort_keys=True))
+
 
 
 
@@ -235,6 +302,381 @@ def t_read_insert(db, table):
 
 
 
+def t_read_iter(db, table):
+
+  print ("\n---------  read_iter with batch_size=2 ---------------\n")
+  for row in db.read_iter(table, sort_cols=[('ticker', 'ASC')], batch_size=2): print(row)
+
+
+def t_transaction(db, table):
+
+  print ("\n---------  transaction commit and rollback ---------------\n")
+  with db.transaction():
+    db.update(table, {'price': 57}, [('ticker', '=', 'ibm')])
+    db.update(table, {'price': 35}, [('ticker', '=', 'dal')])
+
+    try:
+      with db.transaction():
+        db.update(table, {'price': 0}, [('ticker', '=', 'xom')])
+        raise DbAccessorError('roll back the inner block')
+    except DbAccessorError as e:
+      print('inner block rolled back: %s' % e)
+
+  for row in db.read(table, sort_cols=[('ticker', 'ASC')]): print(row)
+
+
+def t_bulk_insert(db):
+
+  print ("\n---------  bulk_insert ---------------\n")
+  table = 'bulk_stocks'
+  db.drop_table(table)
+  db.create_table(table, [('id', 'integer primary key autoincrement not null'),
+    ('ticker', 'text unique'), ('industry', 'text'), ('beta', 'numeric'), ('price', 'numeric')])
+  db.create_index(table, 'ticker')
+  db.create_index(table, 'industry', unique=False)
+  print("indexes dropped by defer_indexes: %s" % [name for name, _ in db.get_index_sql_list(table)])
+
+  rows = ({'ticker': 't%05d' % i, 'industry': 'technology', 'beta': 1.0, 'price': i} for i in range(25000))
+  stats = db.bulk_insert(table, rows, chunk_size=10000, defer_indexes=True)
+  print("inserted %(rows)d rows in %(chunks)d chunks" % stats)
+
+  rows = ((None, 'u%05d' % i, 'energy', 1.5, i) for i in range(10))
+  stats = db.bulk_insert(table, rows)
+  print("inserted %(rows)d tuple rows" % stats)
+
+  print("rows in table: %d" % db.execute('select count(*) from %s' % table).fetchone()[0])
+  print("indexes after load: %s" % db.get_index_names())
+  db.drop_table(table)
+
+
+def t_upsert(db, table):
+
+  print ("\n---------  insert with on_conflict ---------------\n")
+  feed = [{'ticker': 'xom', 'industry': 'energy', 'beta': 0.9, 'price': 60},
+          {'ticker': 'ge', 'industry': 'industrials', 'beta': 1.0, 'price': 12}]
+
+  db.insert(table, feed, on_conflict='ignore')
+  db.display_table(table, "after on_conflict='ignore' (xom unchanged, ge added)")
+
+  feed[1]['price'] = 13
+  db.insert(table, feed, on_conflict='update', conflict_cols=['ticker'], update_cols=['beta', 'price'])
+  db.display_table(table, "after on_conflict='update' (xom and ge updated)")
+
+  db.delete(table, [('ticker', '=', 'ge')])
+
+  # bulk upserts on a table whose only unique constraint is a create_index index
+  upsert_table = 'upsert_stocks'
+  db.drop_table(upsert_table)
+  db.create_table(upsert_table, [('ticker', 'text'), ('price', 'numeric')])
+  db.create_index(upsert_table, 'ticker')
+  rows = [('ibm', 1), ('dal', 2), ('ibm', 3)]
+  stats = db.bulk_insert(upsert_table, rows, defer_indexes=True, on_conflict='ignore')
+  print("defer_indexes with on_conflict='ignore': %d rows, table: %s" % (stats['rows'],
+    db.read(upsert_table, sort_cols=[('ticker', 'ASC')], row_format='tuple')))
+  db.bulk_insert(upsert_table, rows, defer_indexes=True, on_conflict='update', conflict_cols=['ticker'],
+    update_cols=['price'])
+  print("defer_indexes with on_conflict='update': %s" % db.read(upsert_table, sort_cols=[('ticker', 'ASC')],
+    row_format='tuple'))
+  db.drop_table(upsert_table)
+
+
+def t_update_delete_many(db, table):
+
+  print ("\n---------  update_many and delete_many ---------------\n")
+  rows = [{'ticker': 'ibm', 'price': 58}, {'ticker': 'dal', 'price': 36}, {'ticker': 'none', 'price': 1}]
+  print("update_many updated %d rows" % db.update_many(table, rows, ['ticker']))
+
+  db.insert(table, [{'ticker': 'tmp1'}, {'ticker': 'tmp2'}])
+  print("delete_many deleted %d rows" % db.delete_many(table, 'ticker', ['tmp1', 'tmp2', 'tmp3']))
+
+  db.display_table(table, "after update_many and delete_many")
+
+
+def t_stmt_cache(db, table):
+
+  print ("\n---------  statement cache ---------------\n")
+  for price in (10, 20, 30):
+    db.read(table, ['ticker', 'price'], [('price', '>', price)], [('ticker', 'ASC')])
+  print("statement cache stats: %s" % db.get_stmt_cache_stats())
+
+  # a cached shape must not let a bad IN or BETWEEN value through
+  db.read(table, ['ticker'], [('ticker', 'IN', ['x', 'y', 'z'])])
+  db.read(table, ['ticker'], [('price', 'BETWEEN', (1, 2))])
+  for where_row_list in ([('ticker', 'IN', 'ibm')], [('price', 'BETWEEN', (1, 2, 3))]):
+    try:
+      print("not caught: %s" % db.read(table, ['ticker'], where_row_list))
+    except DbAccessorError as e:
+      print("cached shape, DbAccessorError: %s" % e)
+
+
+def t_read_page(db, table):
+
+  print ("\n---------  limit, offset and read_page ---------------\n")
+  print(db.read(table, ['ticker'], sort_cols=[('ticker', 'ASC')], limit=2, offset=1))
+
+  sort_cols = [('industry', 'DESC'), ('ticker', 'ASC')]
+  rows, cursor = db.read_page(table, ['ticker', 'industry'], sort_cols=sort_cols, page_size=3)
+  print(rows)
+  while cursor:
+    print("cursor: %s" % cursor)
+    rows, cursor = db.read_page(table, ['ticker', 'industry'], sort_cols=sort_cols, page_size=3, cursor=cursor)
+    print(rows)
+
+  # an IN list longer than max_variables is split over several selects
+  tickers = ['ibm', 'dal', 'xom', 'appl'] + ['t%05d' % i for i in range(db.max_variables + 10)]
+  where_row_list = [('ticker', 'IN', tickers)]
+  pages = []
+  rows, cursor = db.read_page(table, ['ticker'], where_row_list, [('ticker', 'DESC')], page_size=3)
+  pages.append(rows)
+  while cursor:
+    rows, cursor = db.read_page(table, ['ticker'], where_row_list, [('ticker', 'DESC')], page_size=3, cursor=cursor)
+    pages.append(rows)
+  print("pages with a split IN list: %s" % pages)
+
+  try:
+    db.read_page(table, ['ticker'], page_size=0)
+  except DbAccessorError as e:
+    print("DbAccessorError: %s" % e)
+
+
+def t_where_predicates(db, table):
+
+  print ("\n---------  IN, BETWEEN, LIKE, IS NULL and OR groups ---------------\n")
+  where_row_list = [('ticker', 'IN', ['ibm', 'dal', 'xom', 'msft']), ('price', 'BETWEEN', (30, 60))]
+  for row in db.read(table, ['ticker', 'price'], where_row_list, [('ticker', 'ASC')]): print(row)
+
+  where_row_list = [('industry', 'IS NOT NULL'),
+    ('OR', [[('ticker', 'LIKE', 'a%')], [('industry', '=', 'energy'), ('beta', '<', 1.0)]])]
+  for row in db.read(table, ['ticker', 'industry'], where_row_list, [('ticker', 'ASC')]): print(row)
+
+  tickers = ['ibm', 'dal', 'xom'] + ['t%05d' % i for i in range(db.max_variables + 10)]
+  rows = db.read(table, ['ticker'], [('ticker', 'IN', tickers)], [('ticker', 'DESC')])
+  print("IN list of %d values split over several selects: %s" % (len(tickers), rows))
+
+  # sorting on a column that is not read works with a short or a split IN list
+  for in_list in (tickers[:3], tickers):
+    for row_format in ('dict', 'tuple', 'namedtuple'):
+      rows = db.read(table, ['ticker'], [('ticker', 'IN', in_list)], [('price', 'DESC'), ('ticker', 'ASC')],
+        row_format=row_format)
+      print("%d values, sorted on price, %s: %s" % (len(in_list), row_format, rows))
+
+
+def t_explain(db, table):
+
+  print ("\n---------  explain ---------------\n")
+  result = db.explain(table, ['ticker'], [('industry', '=', 'technology'), ('price', '>', 30)],
+    [('ticker', 'ASC')])
+  for step in result['plan']: print(step)
+  print("scans: %s" % result['scans'])
+  print("temp b-trees: %s" % result['temp_btrees'])
+  for suggestion in result['suggestions']: print(suggestion['call'])
+
+  tickers = ['t%05d' % i for i in range(db.max_variables + 10)]
+  result = db.explain(table, ['ticker'], [('ticker', 'IN', tickers)])
+  print("explain a split IN list: %s" % [step['detail'] for step in result['plan']])
+
+  # the index for the where column alone is covered by the sort index
+  result = db.explain(table, ['ticker'], [('industry', '=', 'energy')], [('price', 'DESC')])
+  print("suggestions: %s" % [suggestion['call'] for suggestion in result['suggestions']])
+
+  flagged = []
+  plan_db = DbAccessor(db.dbpath, explain_queries=flagged.append)
+  plan_db.read(table, where_row_list=[('beta', '>', 1.0)])
+  plan_db.read(table, where_row_list=[('ticker', '=', 'ibm')])
+  print("plans seen: %d, flagged: %s" % (len(plan_db.get_query_plans()), [p['scans'] for p in flagged]))
+  plan_db.close()
+
+  plan_db = DbAccessor(db.dbpath, explain_queries=True, query_plans_size=2)
+  for n in range(1, 6): plan_db.read(table, ['ticker'], [('ticker', 'IN', ['t%d' % i for i in range(n)])])
+  print("plans kept with query_plans_size=2: %d" % len(plan_db.get_query_plans()))
+  plan_db.close()
+
+
+def t_metrics(dbpath, table):
+
+  print ("\n---------  statement metrics ---------------\n")
+  db = DbAccessor(dbpath, metrics=True, slow_query_threshold=0.0)
+
+  for ticker in ('ibm', 'dal', 'xom'):
+    db.read(table, ['ticker', 'price'], [('ticker', 'IN', [ticker, 'none'])])
+  db.update(table, {'price': 58}, [('ticker', '=', 'ibm')])
+  print("rows from read_iter: %d" % sum(1 for row in db.read_iter(table, ['ticker'], batch_size=2)))
+  try:
+    db.read('no_such_table', ['x'])
+  except Exception as e:
+    print("caught: %s" % e)
+
+  metrics = db.get_metrics()
+  for sql, stats in sorted(metrics['statements'].items()):
+    print("%d calls, %d rows: %s" % (stats['count'], stats['rows'], sql))
+  print("errors: %s" % metrics['errors'])
+  print("last slow query: %s" % metrics['slow_queries'][-1])
+  print(db.get_metrics('prometheus').splitlines()[2])
+  db.close()
+
+
+def t_result_cache(dbpath, table):
+
+  print ("\n---------  result cache ---------------\n")
+  db = DbAccessor(dbpath, result_cache_size=100, result_cache_ttl=60, watch_data_version=True)
+  where_row_list = [('ticker', '=', 'xom')]
+
+  for i in range(3): db.read(table, ['ticker', 'price'], where_row_list)
+  print("after 3 reads: %s" % db.get_result_cache_stats())
+
+  db.update(table, {'price': 61}, where_row_list)
+  print("after update: %s" % db.read(table, ['ticker', 'price'], where_row_list))
+
+  other = DbAccessor(dbpath)
+  other.update(table, {'price': 62}, where_row_list)
+  other.close()
+  print("after update by another connection: %s" % db.read(table, ['ticker', 'price'], where_row_list))
+
+  try:
+    with db.transaction():
+      db.update(table, {'price': 0}, where_row_list)
+      print("inside transaction: %s" % db.read(table, ['ticker', 'price'], where_row_list))
+      raise DbAccessorError('roll back')
+  except DbAccessorError:
+    pass
+  print("after rollback: %s" % db.read(table, ['ticker', 'price'], where_row_list))
+
+  # a schema-qualified or quoted name is the same table to the cache
+  for name in ('main.%s' % table, '"%s"' % table):
+    db.read(name, ['ticker', 'price'], where_row_list)
+    db.update(table, {'price': 63}, where_row_list)
+    print("read %s after update: %s" % (name, db.read(name, ['ticker', 'price'], where_row_list)))
+    db.update(table, {'price': 62}, where_row_list)
+
+  print(db.get_result_cache_stats())
+  db.close()
+
+  # pooled: another thread must not be served a transaction's
+  # uncommitted rows from the cache
+  db = DbAccessor(dbpath, pool_size=2, result_cache_size=10)
+  read_in_tx, other_done = threading.Event(), threading.Event()
+  seen = []
+
+  def writer():
+    try:
+      with db.transaction():
+        db.update(table, {'price': 0}, where_row_list)
+        seen.append(('writer inside transaction', db.read(table, ['ticker', 'price'], where_row_list)))
+        read_in_tx.set()
+        other_done.wait()
+        raise DbAccessorError('roll back')
+    except DbAccessorError:
+      pass
+
+  def reader():
+    read_in_tx.wait()
+    seen.append(('other thread', db.read(table, ['ticker', 'price'], where_row_list)))
+    other_done.set()
+
+  threads = [threading.Thread(target=writer), threading.Thread(target=reader)]
+  for t in threads: t.start()
+  for t in threads: t.join()
+
+  for name, rows in seen: print("pooled, %s: %s" % (name, rows))
+  print("pooled, after rollback: %s" % db.read(table, ['ticker', 'price'], where_row_list))
+  db.close()
+
+
+def t_row_format(db, table):
+
+  print ("\n---------  row_format ---------------\n")
+  columns = ['ticker', 'price']
+  sort_cols = [('ticker', 'ASC')]
+  for row_format in ('dict', 'tuple', 'namedtuple', 'row'):
+    rows = db.read(table, columns, sort_cols=sort_cols, limit=2, row_format=row_format)
+    print("%s: %s, ticker of first row: %s" % (row_format, [tuple(r) if row_format == 'row' else r for r in rows],
+      rows[0][0] if row_format != 'dict' else rows[0]['ticker']))
+
+  rows, cursor = db.read_page(table, columns, sort_cols=sort_cols, page_size=2, row_format='namedtuple')
+  print("read_page namedtuple: %s" % rows)
+
+
+def t_read_columns(db, table):
+
+  print ("\n---------  read_columns ---------------\n")
+  columns = ['id', 'ticker', 'price']
+  column_dict = db.read_columns(table, columns, sort_cols=[('ticker', 'ASC')], batch_size=2, use_numpy=False)
+  for col_name in columns: print("%s: %s" % (col_name, column_dict[col_name]))
+
+  print("int column widened by a NULL: %s" % DbAccessor.extend_column(DbAccessor.new_column('integer'), (1, None)))
+
+
+def t_validate(dbpath, table):
+
+  print ("\n---------  validate=True ---------------\n")
+  db = DbAccessor(dbpath, validate=True)
+  print(db.read(table, ['ticker', 'price'], [('ticker', '=', 'ibm')]))
+  print("names in another case: %s" % db.read(table.upper(), ['Ticker'], [('TICKER', '=', 'ibm')]))
+
+  bad_calls = [
+    ('read', lambda: db.read(table, ['ticker', 'price; drop table stocks'])),
+    ('read all columns', lambda: db.read('no_such_table')),
+    ('read_columns', lambda: db.read_columns('no_such_table', ['ticker'])),
+    ('read sort', lambda: db.read(table, ['ticker'], sort_cols=[('no_such_col', 'ASC')])),
+    ('update', lambda: db.update(table, {'no_such_col': 1}, [('ticker', '=', 'ibm')])),
+    ('delete', lambda: db.delete('no_such_table', [('ticker', '=', 'ibm')])),
+    ('insert', lambda: db.insert(table, [{'ticker': 'x', 'no_such_col': 1}]))]
+  for name, call in bad_calls:
+    try:
+      call()
+      print("%s: not caught" % name)
+    except DbSchemaValidatorError as error:
+      print("%s: DbSchemaValidatorError: %s" % (name, error))
+
+  db.conn.execute("create table validate_probe (a text)")
+  print("table created by raw execute: %s" % db.read('validate_probe', ['a']))
+  db.conn.execute("drop table validate_probe")
+  print("validated shapes: %d" % len(db.validated_shapes))
+  db.close()
+
+
+def t_aggregate(db, table):
+
+  print ("\n---------  count, exists and aggregate ---------------\n")
+  print("count: %s" % db.count(table))
+  print("count technology: %s" % db.count(table, [('industry', '=', 'technology')]))
+  print("exists ibm: %s, exists zzz: %s" % (db.exists(table, [('ticker', '=', 'ibm')]),
+    db.exists(table, [('ticker', '=', 'zzz')])))
+
+  rows = db.aggregate(table, ['industry'], {'price': ['avg', 'max'], '*': 'count'},
+    having=[('count', '>=', 1)], sort_cols=[('avg_price', 'DESC')])
+  for row in rows: print(row)
+
+  print(db.aggregate(table, aggs={'price': 'sum', 'beta': ['min', 'max']}))
+
+  try:
+    db.aggregate(table, ['industry'], {'price': 'avg'}, sort_cols=[('price', 'ASC')])
+  except DbAccessorError as e:
+    print("DbAccessorError: %s" % e)
+
+
+def t_export_import(db, table):
+
+  print ("\n---------  export and import_ ---------------\n")
+  copy_table = 'stocks_copy'
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    for file_name in ('stocks.csv', 'stocks.jsonl.gz'):
+      path = os.path.join(tmp_dir, file_name)
+      stats = db.export(table, path, sort_cols=[('ticker', 'ASC')])
+      print("%s: exported %d rows" % (file_name, stats['rows']))
+
+      db.drop_table(copy_table)
+      db.create_table(copy_table, db.get_field_name_type_list(table))
+      stats = db.import_(path, copy_table, chunk_size=2)
+      print("%s: imported %d rows in %d chunks" % (file_name, stats['rows'], stats['chunks']))
+      print("same rows: %s" % (db.read(table, sort_cols=[('id', 'ASC')]) == db.read(copy_table, sort_cols=[('id', 'ASC')])))
+
+  finally:
+    db.drop_table(copy_table)
+    shutil.rmtree(tmp_dir)
+
+
 def t_update(db, table):
   set_row = {'industry': 'finance', 'beta':3.0}
   where_row_list = [('ticker', '=', 'ibm')]
@@ -255,6 +697,107 @@ def t_no_where_rows(db, table):
   print ("\n---------  select table no where_rows ---------------\n")
   for row in db.read(table): print(row)    
 
+def t_read_only(dbpath, table):
+
+  print ("\n---------  mode='ro' and mode='immutable' ---------------\n")
+  for mode in ('ro', 'immutable'):
+    db = DbAccessor(dbpath, mode=mode, watch_schema_version=True)
+    print("%s: %d rows, first: %s" % (mode, db.count(table), db.read(table, ['ticker'], sort_cols=[('ticker', 'ASC')], limit=1)))
+
+    try:
+      db.insert(table, [{'ticker': 'ro'}])
+    except DbAccessorError as e:
+      print("DbAccessorError: %s" % e)
+    db.close()
+
+  try:
+    DbAccessor(dbpath + '.missing', mode='ro')
+  except IOError as e:
+    print("IOError: %s" % e)
+
+
+def sum_prices(rows):
+  # runs in the parallel_read worker processes
+  return sum(row['price'] for row in rows)
+
+
+def t_parallel_read(dbpath, table):
+
+  print ("\n---------  parallel_read ---------------\n")
+  db = DbAccessor(dbpath)
+  sort_cols = [('price', 'DESC'), ('ticker', 'ASC')]
+  rows = db.parallel_read(table, ['ticker', 'price'], sort_cols=sort_cols, workers=2, partitions=3)
+  print("same rows as read: %s" % (rows == db.read(table, ['ticker', 'price'], sort_cols=sort_cols)))
+  for row in rows: print(row)
+
+  total = db.parallel_read(table, ['price'], workers=2, func=sum_prices, reduce=operator.add)
+  print("sum of prices: %s" % total)
+  print("key ranges: %s" % DbAccessor.get_key_ranges('rowid', 1, 10, 3))
+  print("key ranges of a column: %s" % DbAccessor.get_key_ranges('k', 1, 10, 2))
+
+  # rows with a NULL key_col are read too; a text key_col is refused
+  db.create_table('parallel_keys', [('k', 'integer'), ('name', 'text')])
+  db.insert('parallel_keys', [{'k': None if i % 3 == 0 else i, 'name': 'n%d' % i} for i in range(30)])
+  print("rows read, 10 of them with k NULL: %d of %d" % (len(db.parallel_read('parallel_keys', key_col='k', workers=2)),
+    db.count('parallel_keys')))
+  try:
+    db.parallel_read('parallel_keys', key_col='name', workers=2)
+  except DbAccessorError as e:
+    print("DbAccessorError: %s" % e)
+  db.drop_table('parallel_keys')
+  db.close()
+
+
+def t_pool(dbpath, table):
+
+  print ("\n---------  pooled accessor shared by threads ---------------\n")
+  db = DbAccessor(dbpath, pool_size=2, pool_max_idle=60)
+
+  counts = []
+  def worker(n):
+    for i in range(20):
+      counts.append(len(db.read(table)))
+    with db.transaction():
+      db.update(table, {'beta': 1.0 + n}, [('ticker', '=', 'dal')])
+
+  threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+  for t in threads: t.start()
+  for t in threads: t.join()
+
+  print("reads: %d, row counts seen: %s" % (len(counts), sorted(set(counts))))
+  print("pool stats: %s" % db.get_pool_stats())
+  db.close()
+
+
+def t_async(dbpath, table):
+
+  print ("\n---------  AsyncDbAccessor ---------------\n")
+
+  async def run():
+    async with AsyncDbAccessor(dbpath, max_pending=8) as adb:
+      reads = [adb.read(table, where_row_list=[('beta', '>', 1.0)]) for i in range(5)]
+      results = await asyncio.gather(*reads)
+      print("concurrent reads returned %s rows" % [len(r) for r in results])
+
+      async for row in adb.read_iter(table, sort_cols=[('ticker', 'ASC')], batch_size=2):
+        print(row)
+
+  asyncio.run(run())
+
+
+def t_profiles(dbpath):
+
+  print ("\n---------  PRAGMA profiles ---------------\n")
+  for profile in sorted(DbAccessor.PRAGMA_PROFILES):
+    db = DbAccessor(dbpath, profile=profile)
+    print("%s: %s" % (profile, db.get_pragmas()))
+    db.close()
+
+  db = DbAccessor(dbpath, profile='read-heavy', pragmas={'cache_size': -2000})
+  print("read-heavy with cache_size override: %s" % db.get_pragmas(['cache_size', 'mmap_size']))
+  db.close()
+
+
 def test_data_definitions(db, table):
   print_schema(db)
 
@@ -266,6 +809,8 @@ def test_data_definitions(db, table):
 
   print_schema(db)
   t_create_drop_index(db, table)
+  t_composite_index(db, table)
+  t_schema_cache(db.dbpath, table)
 
   print_schema(db)
 
@@ -273,6 +818,22 @@ def test_data_manipulation(db, table):
   initial_insert(db, table)
   t_read_insert(db, table)
   t_no_where_rows(db, table)
+  t_read_iter(db, table)
+  t_transaction(db, table)
+  t_bulk_insert(db)
+  t_upsert(db, table)
+  t_update_delete_many(db, table)
+  t_stmt_cache(db, table)
+  t_read_page(db, table)
+  t_where_predicates(db, table)
+  t_explain(db, table)
+  t_metrics(db.dbpath, table)
+  t_result_cache(db.dbpath, table)
+  t_row_format(db, table)
+  t_read_columns(db, table)
+  t_validate(db.dbpath, table)
+  t_aggregate(db, table)
+  t_export_import(db, table)
   t_update(db, table)
   t_delete(db, table)  
   print("\n\n") 
@@ -335,6 +896,11 @@ def main():
 
   test_data_manipulation(db, table)
 
+  t_read_only(dbpath, table)
+  t_parallel_read(dbpath, table)
+  t_pool(dbpath, table)
+  t_async(dbpath, table)
+  t_profiles(dbpath)
 
   db.close()
 